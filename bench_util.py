@@ -0,0 +1,74 @@
+# bench_util.py
+# -*- coding: utf-8 -*-
+
+"""What the *_bench.py scripts share: timing, the baseline options, and
+comparing results against a baseline.
+
+Every result is a (name, milliseconds) pair, lower is better.
+"""
+
+
+import json
+import sys
+import time
+
+
+def timed(func, *args):
+    """Runs func(*args). Returns elapsed seconds."""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+
+def per_round(func, rounds):
+    """Milliseconds per call of func, over rounds calls."""
+    return timed(lambda: [func() for ___ in xrange(rounds)]) / rounds * 1000
+
+
+
+def compare(results, baseline, tolerance):
+    """Prints results against baseline. Returns regressed result names."""
+    regressions = []
+    for name, ms in results:
+        line = '%-40s %12.4f ms' % (name, ms)
+        if name in baseline:
+            ratio = ms / max(baseline[name], 1e-6)
+            line += '  %6.2fx baseline' % ratio
+            if ratio > 1 + tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print line
+    return regressions
+
+
+
+def add_baseline_options(parser):
+    """Adds --baseline, --tolerance and --save to an OptionParser."""
+    parser.add_option("-b", "--baseline", action="store",
+                      help="compare against this baseline file")
+    parser.add_option("-t", "--tolerance", action="store", type="float",
+                      default=0.25, help="slowdown allowed over the baseline")
+    parser.add_option("--save", action="store",
+                      help="save results as a baseline file")
+
+
+
+def report(results, opts):
+    """Prints results, against the baseline if given, and saves them if
+    asked to. Exits with status 1 if something got slower than the
+    baseline allows.
+
+    @opts:  parsed options, see add_baseline_options
+    """
+    baseline = {}
+    if opts.baseline:
+        baseline = json.load(open(opts.baseline))
+    regressions = compare(results, baseline, opts.tolerance)
+
+    if opts.save:
+        json.dump(dict(results), open(opts.save, 'w'), indent=1,
+            sort_keys=True)
+    if regressions:
+        print '%d regression(s): %s' % (len(regressions), ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,10 @@
+# gmetric_collectors/__init__.py
+# -*- coding: utf-8 -*-
+
+"""Collectors of gmetric_feeder, one module each.
+
+A module is named as its collector (as used on the command line and the
+config file), and registers a Gmetric subclass as COLLECTOR. Modules are
+imported only when their collector is enabled: keep this file empty of
+imports.
+"""
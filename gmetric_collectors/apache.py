@@ -0,0 +1,198 @@
+# gmetric_collectors/apache.py
+# -*- coding: utf-8 -*-
+
+"""Apache mod_status, through keep-alive connections.
+"""
+
+
+import httplib
+import logging
+import urlparse
+
+from gmetric_feeder import Gmetric, named_entries, run_collectors
+
+
+
+class HttpPool (object):
+    """Keep-alive HTTP connections, one per endpoint, reused between scrapes.
+    Endpoints are named by the caller (the URL by default); a connection is
+    never used by two threads at once as long as every thread fetches its
+    own endpoint.
+    """
+
+    def __init__ (self, connect_timeout=2.0, read_timeout=5.0):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.conns = {}
+
+
+    def __connect__ (self, scheme, netloc):
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc,
+                timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+
+    def drop (self, endpoint):
+        """Forget the connection to an endpoint."""
+        conn = self.conns.pop(endpoint, None)
+        if conn:
+            conn.close()
+
+
+    def get (self, url, endpoint=None):
+        """Body of url. Raises IOError (socket.error included) or
+        httplib.HTTPException when the page can not be retrieved."""
+        endpoint = endpoint or url
+        scheme, netloc, path, query, ___ = urlparse.urlsplit(url)
+        if query:
+            path = '%s?%s' % (path, query)
+
+        # A reused connection may have been closed by the server meanwhile:
+        # retry once on a fresh one.
+        for attempt in (0, 1):
+            conn = self.conns.get(endpoint)
+            reused = conn is not None
+            if not reused:
+                conn = self.conns[endpoint] = self.__connect__(scheme, netloc)
+            try:
+                conn.request('GET', path or '/')
+                response = conn.getresponse()
+                body = response.read()
+            except (IOError, httplib.HTTPException):
+                self.drop(endpoint)
+                if reused and not attempt:
+                    continue
+                raise
+            if response.will_close:
+                self.drop(endpoint)
+            if response.status != 200:
+                raise IOError('%s: HTTP %s' % (url, response.status))
+            return body
+
+
+
+# Worker states on mod_status' scoreboard: (character, metric name suffix).
+APACHE_SCOREBOARD = (
+    ('_', 'waiting'),
+    ('S', 'starting'),
+    ('R', 'reading'),
+    ('W', 'writing'),
+    ('K', 'keepalive'),
+    ('D', 'dns'),
+    ('C', 'closing'),
+    ('L', 'logging'),
+    ('G', 'graceful'),
+    ('I', 'cleanup'),
+    ('.', 'open'),
+)
+
+
+class Apache (Gmetric):
+    """Gets data from Apache mod_status and digest it for gmetric.
+
+    Put something like this on your Apache configuration.
+
+    ExtendedStatus On
+    <Location /server-status>
+        SetHandler server-status
+        Order deny,allow
+        Deny from all
+        Allow from 127.0.0.1
+    </Location>
+    """
+    
+    def __init__ (self, url=None, connect_timeout=2.0, read_timeout=5.0):
+        """Initializes values.
+
+        %url: (optional) one status URL, or a list of them (a string with
+              commas works too). Every URL can be given as 'prefix=URL';
+              metrics of that endpoint will be named 'prefix_*'.
+        %connect_timeout, %read_timeout: (optional) seconds
+        """
+        
+        params = (
+            ( 'BytesPerSec', 'apache_bytes', 'int16', 'Bytes/sec'),
+            ( 'ReqPerSec', 'apache_hits', 'float', 'Requests/sec'),
+            ( 'BusyWorkers', 'apache_workers_busy', 'int16', 'Processes'),
+            ( 'IdleWorkers', 'apache_workers_idle', 'int16', 'Processes'),
+            ( 'Total Accesses', 'apache_accesses', 'float', 'Requests/sec'),
+            ( 'Total kBytes', 'apache_traffic', 'float', 'kBytes/sec'),
+        ) + tuple( ('Scoreboard ' + state, 'apache_slots_' + state, 'uint32',
+            'Slots')  for ___, state in APACHE_SCOREBOARD )
+        self.counters = frozenset(['Total Accesses', 'Total kBytes'])
+
+        if not url:
+            url = ['http://localhost/server-status/?auto']
+        self.endpoints = named_entries(url, 'apache',
+            lambda u: urlparse.urlsplit(u)[1])
+        self.params = self.prefixed_params(params,
+            [ prefix  for prefix, ___ in self.endpoints ])
+
+        self.pool = HttpPool(float(connect_timeout), float(read_timeout))
+        self.timeout = self.pool.connect_timeout + self.pool.read_timeout
+            
+        super( Apache, self ).__init__()
+
+
+    def fetch (self, prefix, url):
+        """Parsed '?auto' page of one endpoint."""
+        try:
+            page = self.pool.get(url, prefix)
+        except (IOError, httplib.HTTPException), err:
+            # Unable to get the page. Don't save any value, but keep running.
+            logging.warning('%s: %s', url, err)
+            return None
+        return self.parse(page)
+
+
+    def parse (self, page):
+        """Dictionary from an '?auto' page, scoreboard counted by state."""
+        status = [line.split(': ', 1) for line in page.splitlines()]
+        try:
+            status = dict(status)
+        except ValueError:
+            # The /server-status page can not be retrieved.
+            return None
+
+        # str.count() walks the scoreboard in C, once per state; far cheaper
+        # than a Python loop over thousands of slots.
+        scoreboard = status.pop('Scoreboard', None)
+        if scoreboard:
+            for char, state in APACHE_SCOREBOARD:
+                status['Scoreboard ' + state] = scoreboard.count(char)
+        return status
+
+        
+    def get_status (self):
+        """Retrieve data from Apache's mod_status, every endpoint at once.
+        """
+        if len(self.endpoints) == 1:
+            # Nothing to overlap: don't pay for a thread. The pool timeouts
+            # still bound it.
+            prefix, url = self.endpoints[0]
+            status = self.fetch(prefix, url) or {}
+            return dict( ('%s:%s' % (prefix, key), value)
+                for key, value in status.items() ) or None
+
+        results, stale = run_collectors([
+            (name, lambda name=name, address=address: self.fetch(name,
+                address), self.timeout)
+            for name, address in self.endpoints ])
+        for name in stale:
+            self.pool.drop(name)
+
+        data = {}
+        for prefix, status in results.items():
+            for key, value in (status or {}).items():
+                data['%s:%s' % (prefix, key)] = value
+        return data or None
+
+
+
+# Registered as the collector of this module, see gmetric_feeder.
+COLLECTOR = Apache
@@ -0,0 +1,255 @@
+# gmetric_collectors/exim.py
+# -*- coding: utf-8 -*-
+
+"""Exim queues, from its spool directories.
+"""
+
+
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import time
+
+from gmetric_feeder import Gmetric, oneliner, true_value
+
+
+
+class Inotify (object):
+    """Minimal non-blocking inotify, through libc."""
+
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0x80000
+
+    event = struct.Struct('iIII')
+
+    def __init__ (self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+
+    def add_watch (self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch', path)
+        return wd
+
+
+    def close (self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    __del__ = close
+
+
+    def read (self):
+        """Pending events as (wd, mask, name). Never blocks."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, err:
+                if err.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, ___, length = self.event.unpack_from(buf, offset)
+                offset += self.event.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, name))
+
+
+
+# Message ids start with their arrival time, in base 62.
+BASE62 = dict( (c, i)  for i, c in enumerate(
+    '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz') )
+
+# Queue age histogram: (suffix, upper bound in seconds).
+EXIM_AGES = (('5m', 300), ('1h', 3600), ('6h', 21600), ('1d', 86400),
+    ('older', None))
+
+
+class EximSpool (object):
+    """Messages on an Exim spool, found by their '-H' files. Subdirectories
+    of a split spool are read too.
+
+    Once watch() is called, the spool is read only once and then kept up to
+    date through inotify.
+    """
+
+    WATCH_MASK = (Inotify.IN_CREATE | Inotify.IN_DELETE |
+        Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO)
+
+    def __init__ (self, spool):
+        self.input = os.path.join(spool, 'input')
+        self.messages = set()
+        self.inotify = None
+        # wd -> directory
+        self.watches = {}
+
+
+    def __scan_dir__ (self, path):
+        """Message ids in one directory. Returns (ids, subdirectories)."""
+        ids = []
+        subdirs = []
+        for name in os.listdir(path):
+            if name.endswith('-H'):
+                ids.append(name[:-2])
+            elif len(name) == 1:
+                subdirs.append(os.path.join(path, name))
+        return ids, subdirs
+
+
+    def scan (self):
+        """Reads the whole spool again."""
+        messages = set()
+        ids, subdirs = self.__scan_dir__(self.input)
+        messages.update(ids)
+        for subdir in subdirs:
+            if self.inotify:
+                self.__watch_dir__(subdir)
+            messages.update(self.__scan_dir__(subdir)[0])
+        self.messages = messages
+
+
+    def __watch_dir__ (self, path):
+        if path not in self.watches.values():
+            self.watches[self.inotify.add_watch(path, self.WATCH_MASK)] = path
+
+
+    def watch (self):
+        """Keep the spool up to date through inotify from now on."""
+        self.inotify = Inotify()
+        self.__watch_dir__(self.input)
+        self.scan()
+
+
+    def update (self):
+        """Applies changes since last update. Reads the whole spool if not
+        watching it, or if the kernel dropped events."""
+        if not self.inotify:
+            return self.scan()
+
+        for wd, mask, name in self.inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                logging.warning('%s: inotify overflow, rescanning', self.input)
+                return self.scan()
+            if mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    path = os.path.join(self.watches[wd], name)
+                    self.__watch_dir__(path)
+                    self.messages.update(self.__scan_dir__(path)[0])
+            elif name.endswith('-H'):
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.messages.add(name[:-2])
+                else:
+                    self.messages.discard(name[:-2])
+
+
+    def ages (self, now):
+        """Messages per EXIM_AGES bucket, by suffix."""
+        counts = [0] * len(EXIM_AGES)
+        bounds = [ bound  for ___, bound in EXIM_AGES[:-1] ]
+        for msgid in self.messages:
+            try:
+                arrival = 0
+                for char in msgid[:6]:
+                    arrival = arrival * 62 + BASE62[char]
+            except KeyError:
+                continue
+            counts[bisect.bisect_right(bounds, now - arrival)] += 1
+        return dict( (suffix, count)  for (suffix, ___), count in
+            zip(EXIM_AGES, counts) )
+
+
+
+class Exim (Gmetric):
+    """Parses data about Exim usage.
+
+    Queues are counted on the spool directories. The outgoing queue is the
+    one of the Exim configuration with the OUTGOING macro defined.
+    """
+    
+    def __init__ (self, spool=None, outgoing_spool=None, ages=False):
+        """Initializes values.
+
+        %spool:          (optional) spool directory of the incoming queue
+        %outgoing_spool: (optional) spool directory of the outgoing queue
+        %ages:           (optional) send also queue age histograms
+        Spool directories are asked to Exim if not given.
+        """
+        
+        self.params = [
+            ( 'exim_incoming_queue', 'exim_incoming_queue', 'uint32', 'messages'),
+            ( 'exim_outgoing_queue', 'exim_outgoing_queue', 'uint32', 'messages'),
+        ]
+        self.ages = true_value(ages)
+        if self.ages:
+            self.params += [ ('exim_%s_age_%s' % (queue, suffix),
+                'exim_%s_age_%s' % (queue, suffix), 'int16', 'messages')
+                for queue in ('incoming', 'outgoing')
+                for suffix, ___ in EXIM_AGES ]
+
+        self.spools = {
+            'incoming': spool or self.spool_directory(),
+            'outgoing': outgoing_spool or self.spool_directory('-DOUTGOING'),
+        }
+        self.queues = {}
+        for queue, spool in self.spools.items():
+            if spool:
+                self.queues[queue] = EximSpool(spool)
+                if self.long_running:
+                    try:
+                        self.queues[queue].watch()
+                    except OSError, err:
+                        logging.warning('exim: %s; rescanning every time', err)
+                        self.queues[queue].inotify = None
+
+        super( Exim, self ).__init__()
+
+
+    def spool_directory (self, args=''):
+        """Asks Exim for its spool_directory."""
+        try:
+            output = oneliner('/usr/sbin/exim %s -bP spool_directory' % args)
+        except OSError:
+            return None
+        if not output or '=' not in output:
+            return None
+        return output.split('=', 1)[1].strip()
+
+        
+    def get_status (self):
+        result = {}
+        now = time.time()
+        try:
+            for queue, spool in self.queues.items():
+                spool.update()
+                result['exim_%s_queue' % queue] = len(spool.messages)
+                if self.ages:
+                    for suffix, count in spool.ages(now).items():
+                        result['exim_%s_age_%s' % (queue, suffix)] = count
+        except OSError, err:
+            logging.warning('exim: %s', err)
+            return None
+
+        return result or None
+
+
+
+# Registered as the collector of this module, see gmetric_feeder.
+COLLECTOR = Exim
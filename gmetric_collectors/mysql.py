@@ -0,0 +1,323 @@
+# gmetric_collectors/mysql.py
+# -*- coding: utf-8 -*-
+
+"""MySQL 'SHOW GLOBAL STATUS', through MySQLdb or the 'mysql' client.
+"""
+
+
+import logging
+import math
+import os
+import re
+import time
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+from gmetric_feeder import Gmetric, named_entries, oneliner
+
+
+
+# Type, unit and kind of exported status variables: first matching regexp
+# wins. Counters are sent as per-second rates.
+MYSQL_STATUS_RULES = (
+    # (regexp, rrd_type, unit, counter)
+    (r'Innodb_buffer_pool_pages_(data|dirty|free|misc|total)', 'uint32',
+        'pages', False),
+    (r'Innodb_buffer_pool_bytes_.*', 'double', 'bytes', False),
+    (r'Innodb_buffer_pool_pages_.*', 'float', 'pages/sec', True),
+    (r'Innodb_(data|os_log)_(read|written)', 'float', 'bytes/sec', True),
+    (r'Innodb_buffer_pool_.*', 'float', 'requests/sec', True),
+    (r'Innodb_row_lock_current_waits', 'uint32', 'waits', False),
+    (r'Innodb_row_lock_time_(avg|max)', 'uint32', 'ms', False),
+    (r'Innodb_row_lock_time', 'float', 'ms/sec', True),
+    (r'Innodb_rows_.*', 'float', 'rows/sec', True),
+    (r'Handler_.*', 'float', 'operations/sec', True),
+    (r'Com_.*', 'float', 'queries/sec', True),
+    (r'Bytes_(received|sent)', 'float', 'bytes/sec', True),
+    (r'Threads_created', 'float', 'threads/sec', True),
+    (r'Threads_.*', 'uint32', 'threads', False),
+    (r'Open_.*', 'uint32', 'objects', False),
+    (r'Opened_.*', 'float', 'objects/sec', True),
+    (r'.*', 'double', '', False),
+)
+
+
+
+def compile_any (patterns):
+    """One regexp matching any of the patterns (a string with commas works
+    too), anchored at both ends. None if there are no patterns."""
+    if isinstance(patterns, basestring):
+        patterns = [ p.strip()  for p in patterns.split(',') if p.strip() ]
+    if not patterns:
+        return None
+    return re.compile('(?:%s)$' % '|'.join(patterns))
+
+
+
+class StatusExport (object):
+    """Maps any status variable to a metric (name, type, unit) through
+    allow/deny regexps. Regexps are compiled once, and every variable is
+    matched only the first time it is seen.
+    """
+
+    def __init__ (self, allow=None, deny=None, rules=MYSQL_STATUS_RULES):
+        """Initializes values.
+
+        %allow: regexps of variables to export (nothing by default)
+        %deny:  (optional) regexps of variables never exported
+        %rules: (regexp, rrd_type, unit, counter) tuples
+        """
+        self.allow = compile_any(allow)
+        self.deny = compile_any(deny)
+        self.rules = [ (re.compile(rule[0] + '$'),) + tuple(rule[1:])
+            for rule in rules ]
+        # variable -> (rrd_type, unit, counter), or None if not exported.
+        self.cache = {}
+
+
+    def lookup (self, variable):
+        try:
+            return self.cache[variable]
+        except KeyError:
+            pass
+
+        result = None
+        if self.allow and self.allow.match(variable) and not (
+                self.deny and self.deny.match(variable)):
+            for rule in self.rules:
+                if rule[0].match(variable):
+                    result = rule[1:]
+                    break
+        self.cache[variable] = result
+        return result
+
+
+    def params (self, prefix, variables):
+        """Params for the exported variables, named '<prefix>_<variable>',
+        and the set of variables among them being counters.
+        """
+        result = []
+        counters = set()
+        for variable in variables:
+            info = self.lookup(variable)
+            if info:
+                rrd_type, unit, counter = info
+                result.append(('%s:%s' % (prefix, variable),
+                    '%s_%s' % (prefix, variable.lower()), rrd_type, unit))
+                if counter:
+                    counters.add(variable)
+        return result, counters
+
+
+
+def parse_status (output):
+    """Parses 'SHOW STATUS' output of the 'mysql' client into a dictionary.
+    """
+    result = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if fields:
+            result[fields[0]] = len(fields) > 1 and fields[1] or ''
+    # Column headers.
+    result.pop('Variable_name', None)
+    return result
+
+
+
+class MysqlConnection (object):
+    """Connection to one MySQL instance, kept open between samples. Needs
+    MySQLdb. Reconnects with exponential backoff.
+    """
+
+    def __init__ (self, instance=None, min_backoff=1.0, max_backoff=300.0,
+            connect_timeout=None):
+        """Initializes values.
+
+        %instance: (optional) unix socket path, 'host:port' or a port on
+                   localhost. Default from '~/.my.cnf'.
+        %connect_timeout: (optional) seconds
+        """
+        self.instance = instance
+        self.connect_timeout = connect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.retry_at = 0
+        self.conn = None
+
+
+    def connect_args (self):
+        args = {'read_default_file': os.path.expanduser('~/.my.cnf')}
+        if not self.instance:
+            pass
+        elif self.instance.startswith('/'):
+            args['unix_socket'] = self.instance
+        else:
+            host, ___, port = self.instance.rpartition(':')
+            args['host'] = host or '127.0.0.1'
+            args['port'] = int(port)
+        if self.connect_timeout:
+            args['connect_timeout'] = int(math.ceil(self.connect_timeout))
+        return args
+
+
+    def connect (self):
+        """Opens the connection unless backing off. Returns True if open."""
+        if self.conn is not None:
+            return True
+        if time.time() < self.retry_at:
+            return False
+        try:
+            self.conn = MySQLdb.connect(**self.connect_args())
+            self.conn.autocommit(True)
+        except MySQLdb.Error, err:
+            logging.warning('mysql %s: %s; retry in %ds', self.instance or '',
+                err, self.backoff)
+            self.retry_at = time.time() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return False
+        self.backoff = self.min_backoff
+        return True
+
+
+    def close (self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except MySQLdb.Error:
+                pass
+            self.conn = None
+
+
+    def status (self):
+        """'SHOW GLOBAL STATUS' as a dictionary, or None. A connection lost
+        since last sample is reopened once right away."""
+        for ___ in (0, 1):
+            reused = self.conn is not None
+            if not self.connect():
+                return None
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute('SHOW GLOBAL STATUS')
+                rows = cursor.fetchall()
+                cursor.close()
+                return dict(rows)
+            except MySQLdb.Error, err:
+                logging.warning('mysql %s: %s', self.instance or '', err)
+                self.close()
+                if not reused:
+                    return None
+
+
+
+class Mysql (Gmetric):
+    """Gets status from Mysql and digest it for gmetric.
+
+    Put authentication data on '~/.my.cnf', please.
+
+    Connections are kept open between samples when MySQLdb is installed;
+    otherwise the 'mysql' client is run every time.
+
+    Any other status variable can be exported too, see StatusExport.
+    """
+    
+    def __init__ (self, instance=None, allow=None, deny=None,
+            connect_timeout=None):
+        """Initializes values.
+
+        %instance: (optional) one MySQL instance, or a list of them (a
+                   string with commas works too): unix socket path,
+                   'host:port' or port. Every instance can be given as
+                   'prefix=instance'; its metrics will be named 'prefix_*'.
+        %allow:    (optional) regexps of status variables to export too
+        %deny:     (optional) regexps of status variables never exported
+        %connect_timeout: (optional) seconds
+        """
+        
+        # params format:
+        # (self.data[key], gmetric-type, gmetric-name, gmetric-unit)
+        params = (
+            ('Questions', 'mysql_queries', 'float', 'queries/sec' ),
+            ('Threads_connected', 'mysql_threads_conn', 'uint16', 'threads'),
+            ('Com_select', 'mysql_select_queries', 'float', 'queries/sec'),
+            ('Table_locks_waited', 'mysql_table_locks_waited', 'float',
+                'locks/sec'),
+            ('Slow_queries', 'mysql_slow_queries', 'float', 'queries/sec' ),
+        )
+        self.counters = set(['Questions', 'Com_select', 'Table_locks_waited',
+            'Slow_queries'])
+
+        self.instances = named_entries(instance or [''], 'mysql')
+        self.base_params = self.prefixed_params(params,
+            [ prefix  for prefix, ___ in self.instances ])
+        self.params = self.base_params
+        self.export = StatusExport(allow, deny)
+        # Variables already sent through base_params aren't exported again.
+        self.export.cache.update( (p[0], None)  for p in params )
+        self.variables = None
+        self.connect_timeout = connect_timeout and float(connect_timeout)
+        if MySQLdb:
+            self.conns = dict( (prefix, MysqlConnection(inst or None,
+                connect_timeout=self.connect_timeout))
+                for prefix, inst in self.instances )
+                   
+        super( Mysql, self ).__init__()
+
+
+    def status_cli (self, instance):
+        """'SHOW GLOBAL STATUS' through the 'mysql' client, or None.
+        """
+        cmd = 'mysql'
+        if instance.startswith('/'):
+            cmd += ' --socket=%s' % instance
+        elif instance:
+            host, ___, port = instance.rpartition(':')
+            cmd += ' --protocol=tcp --host=%s --port=%s' % (
+                host or '127.0.0.1', port)
+        if self.connect_timeout:
+            cmd += ' --connect-timeout=%d' % math.ceil(self.connect_timeout)
+
+        try:
+            output = oneliner(cmd, 'SHOW GLOBAL STATUS')
+        except OSError, err:
+            # No 'mysql' client.
+            logging.warning('mysql: %s', err)
+            return None
+        if not output:
+            return None
+        return parse_status(output)
+
+
+    def get_status (self):
+        """Retrieve data from Mysql's 'SHOW GLOBAL STATUS', every instance.
+        """
+        data = {}
+        exported = []
+        for prefix, instance in self.instances:
+            if MySQLdb:
+                status = self.conns[prefix].status()
+            else:
+                status = self.status_cli(instance)
+            if not status:
+                continue
+            for key, value in status.iteritems():
+                data['%s:%s' % (prefix, key)] = value
+            if self.export.allow:
+                params, counters = self.export.params(prefix, status)
+                exported += params
+                self.counters.update(counters)
+
+        # Status variables seldom change: params are rebuilt only if so.
+        variables = frozenset( p[0]  for p in exported )
+        if variables != self.variables:
+            self.variables = variables
+            self.params = self.base_params + sorted(exported)
+        return data or None
+
+
+
+# Registered as the collector of this module, see gmetric_feeder.
+COLLECTOR = Mysql
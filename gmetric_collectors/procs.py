@@ -0,0 +1,274 @@
+# gmetric_collectors/procs.py
+# -*- coding: utf-8 -*-
+
+"""What the processes of every service cost, from /proc.
+"""
+
+
+import logging
+import marshal
+import os
+
+from gmetric_feeder import Gmetric, named_entries, rates, true_value
+
+
+
+# Services and the process names ('comm') their process trees start at.
+PROC_SERVICES = 'apache=apache2|httpd,mysql=mysqld|mariadbd,exim=exim|exim4,' \
+    'vsftpd=vsftpd'
+
+
+class Processes (Gmetric):
+    """What the processes of every service cost, from /proc: CPU, memory,
+    file descriptors, threads and I/O.
+
+    A service is every process named as one of its names, and their
+    children. Processes are classified when first seen, then only the
+    ones of a service are read again, one read of 'stat' per process
+    (plus 'io', 'fd' and 'smaps_rollup' if wanted). CPU and I/O of
+    processes are summed as they go, so children coming and going don't
+    break the rates. What was summed is kept in memory when collectors are
+    long running, on a file next to the rates' state file between one-shot
+    runs (read and rewritten whole, once a run); without either, no CPU nor
+    I/O rates are sent.
+    """
+
+    def __init__ (self, service=None, fds=True, io=True, pss=False,
+            proc='/proc'):
+        """Initializes values.
+
+        %service: (optional) services as 'name=comm|comm...', a list or a
+                  string with commas. Default PROC_SERVICES.
+        %fds:     (optional) count open file descriptors
+        %io:      (optional) read and written bytes
+        %pss:     (optional) proportional memory too; the kernel has to walk
+                  every process' memory for it, so it's far from cheap
+        %proc:    (optional) where procfs is mounted
+        """
+
+        params = (
+            ('count', 'x_procs', 'uint32', 'processes'),
+            ('threads', 'x_proc_threads', 'uint32', 'threads'),
+            ('cpu', 'x_proc_cpu', 'float', 'percent'),
+            ('rss', 'x_proc_rss', 'uint32', 'kB'),
+            ('pss', 'x_proc_pss', 'uint32', 'kB'),
+            ('fds', 'x_proc_fds', 'uint32', 'fds'),
+            ('read', 'x_proc_read', 'float', 'Bytes/sec'),
+            ('write', 'x_proc_write', 'float', 'Bytes/sec'),
+        )
+        self.counters = frozenset(['cpu', 'read', 'write'])
+
+        self.services = [ (name, frozenset(comms.split('|')))
+            for name, comms in named_entries(service or PROC_SERVICES,
+                'proc') ]
+        self.params = self.prefixed_params(params,
+            [ name  for name, ___ in self.services ])
+        self.fds = true_value(fds)
+        self.io = true_value(io)
+        self.pss = true_value(pss)
+        self.proc = proc
+        self.tick = float(os.sysconf('SC_CLK_TCK'))
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+
+        # pid -> service, None for processes of none.
+        self.owner = {}
+        # pid -> (start time, CPU ticks, read bytes, written bytes) of the
+        # processes of a service, as last read.
+        self.last = {}
+        # Service -> [CPU ticks, read bytes, written bytes] of its
+        # processes, summed over time.
+        self.totals = dict( (name, [0, 0, 0])  for name, ___ in self.services )
+
+        super(Processes, self).__init__()
+
+
+    def __read__ (self, path):
+        """Contents of a small /proc file, with as few syscalls as it
+        takes. None if gone or not allowed."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            return os.read(fd, 4096)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+
+    def __stat__ (self, pid):
+        """(comm, fields after comm) from /proc/<pid>/stat, or None."""
+        stat = self.__read__('%s/%s/stat' % (self.proc, pid))
+        if not stat:
+            return None
+        # comm can hold spaces and parens: it ends at the last ')'.
+        head, ___, tail = stat.rpartition(')')
+        return head.partition('(')[2], tail.split()
+
+
+    def __discover__ (self, pids):
+        """Classifies the pids not seen before. Returns the stat fields of
+        the ones found to belong to a service."""
+        fresh = {}
+        for pid in pids:
+            if pid not in self.owner:
+                stat = self.__stat__(pid)
+                if stat:
+                    fresh[pid] = stat
+
+        services = self.services
+        owner = self.owner
+        def classify (pid):
+            if pid in owner:
+                return owner[pid]
+            if pid not in fresh:
+                # Gone, or outside our view: not a service parent.
+                return None
+            comm, fields = fresh[pid]
+            # Marked first, in case the process tree loops meanwhile.
+            owner[pid] = None
+            for name, comms in services:
+                if comm in comms:
+                    owner[pid] = name
+                    return name
+            owner[pid] = classify(fields[1])
+            return owner[pid]
+
+        found = {}
+        for pid, (___, fields) in fresh.iteritems():
+            if classify(pid):
+                found[pid] = fields
+        return found
+
+
+    def __load__ (self, path):
+        """(totals, last) saved on path by a previous run; empty if none."""
+        try:
+            with open(path, 'rb') as saved:
+                totals, last = marshal.load(saved)
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}, {}
+        return totals, last
+
+
+    def __save__ (self, path, totals, last):
+        """Saves (totals, last) on path, replacing it at once. The rates'
+        state file is locked meanwhile, so runs don't overlap."""
+        try:
+            with open(path + '.tmp', 'wb') as saved:
+                marshal.dump((totals, last), saved)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), err:
+            logging.warning('procs: %s; no rates next run', err)
+
+
+    def get_status (self):
+        """Retrieve data from /proc.
+        """
+        try:
+            pids = set( name  for name in os.listdir(self.proc)
+                if name.isdigit() )
+        except OSError, err:
+            logging.warning('procs: %s', err)
+            return None
+        for pid in set(self.owner) - pids:
+            del self.owner[pid]
+            self.last.pop(pid, None)
+
+        # Where the sums live between samples. Only the pids seen this run
+        # are saved, so gone ones don't pile up.
+        saved = None
+        last_seen = kept = self.last
+        if not self.long_running and rates.state is not None:
+            saved = rates.state.path + '.procs'
+            totals, last_seen = self.__load__(saved)
+            for name, ___ in self.services:
+                self.totals[name] = list(totals.get(name, (0, 0, 0)))
+            kept = {}
+
+        found = self.__discover__(pids)
+        # Service -> [processes, threads, rss pages, fds, pss kB]
+        sums = dict( (name, [0, 0, 0, 0, 0])  for name, ___ in self.services )
+        unreadable = set()
+        base = self.proc + '/'
+        last_seen = self.last
+        for pid, service in self.owner.iteritems():
+            if service is None:
+                continue
+            fields = found.get(pid)
+            if fields is None:
+                stat = self.__stat__(pid)
+                if stat is None:
+                    # Gone meanwhile.
+                    continue
+                fields = stat[1]
+            start = fields[19]
+            cpu = int(fields[11]) + int(fields[12])
+            acc = sums[service]
+            acc[0] += 1
+            acc[1] += int(fields[17])
+            acc[2] += int(fields[21])
+
+            read = written = 0
+            if self.io:
+                io = self.__read__(base + pid + '/io')
+                if io is None:
+                    unreadable.add(service + ':read')
+                    unreadable.add(service + ':write')
+                else:
+                    tokens = io.split()
+                    read = int(tokens[tokens.index('read_bytes:') + 1])
+                    written = int(tokens[tokens.index('write_bytes:') + 1])
+            if self.fds:
+                try:
+                    acc[3] += len(os.listdir(base + pid + '/fd'))
+                except OSError:
+                    unreadable.add(service + ':fds')
+            if self.pss:
+                smaps = self.__read__(base + pid + '/smaps_rollup')
+                if smaps is None or 'Pss:' not in smaps:
+                    unreadable.add(service + ':pss')
+                else:
+                    acc[4] += int(smaps.split('Pss:', 1)[1].split(None, 1)[0])
+
+            last = last_seen.get(pid)
+            if last is None or last[0] != int(start):
+                # New process, or a new one under a reused pid.
+                last = (int(start), 0, 0, 0)
+            totals = self.totals[service]
+            totals[0] += cpu - last[1]
+            totals[1] += read - last[2]
+            totals[2] += written - last[3]
+            kept[pid] = (int(start), cpu, read, written)
+
+        if saved is not None:
+            self.__save__(saved, self.totals, kept)
+        rated = self.long_running or saved is not None
+
+        result = {}
+        for name, ___ in self.services:
+            count, threads, rss, fds, pss = sums[name]
+            cpu, read, written = self.totals[name]
+            result[name + ':count'] = count
+            result[name + ':threads'] = threads
+            result[name + ':rss'] = rss * self.page_kb
+            # CPU as centiseconds: its rate is percent of a CPU.
+            if rated:
+                result[name + ':cpu'] = round(cpu * 100 / self.tick, 2)
+            if self.io and rated:
+                result[name + ':read'] = read
+                result[name + ':write'] = written
+            if self.fds:
+                result[name + ':fds'] = fds
+            if self.pss:
+                result[name + ':pss'] = pss
+        # Partial sums would mislead: nothing rather than that.
+        for key in unreadable:
+            result.pop(key, None)
+        return result
+
+
+
+# Registered as the collector of this module, see gmetric_feeder.
+COLLECTOR = Processes
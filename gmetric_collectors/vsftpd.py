@@ -0,0 +1,145 @@
+# gmetric_collectors/vsftpd.py
+# -*- coding: utf-8 -*-
+
+"""vsftpd sessions, from their process titles on /proc.
+"""
+
+
+import logging
+import os
+import pwd
+import re
+
+from gmetric_feeder import Gmetric, true_value
+
+
+# Seconds gmond keeps a client IP metric not sent again, a few times the
+# default tmax: client IPs come and go, their metrics shouldn't pile up.
+IP_DMAX = 300
+
+
+
+class Vsftpd(Gmetric):
+    """Gets status from Vsftpd processes and digest it for gmetric.
+
+    Set 'setproctitle_enable=YES' on your vsftpd.conf to show connection 
+    status per-process.
+
+    Processes are read from /proc. Processes other than vsftpd are seen once
+    and then ignored until they exit; vsftpd processes owned by the FTP user
+    have their title read every time, as it changes along the session.
+    """
+    
+    def __init__ (self, per_ip=False, user='ftp', proc='/proc'):
+        """Initializes values.
+
+        %per_ip: (optional) send also connections per client IP
+        %user:   (optional) user owning the vsftpd session processes
+        %proc:   (optional) where procfs is mounted
+        """
+        
+        self.base_params = [
+            ('vsftpd_clients', 'vsftpd_clients', 'uint16' ),
+            ('vsftpd_data_conn_retr', 'vsftpd_data_conn_retr', 'uint16' ),
+            ('vsftpd_data_conn_idle', 'vsftpd_data_conn_idle', 'uint16' ),
+            ('vsftpd_data_conn_other', 'vsftpd_data_conn_other', 'uint16' ),
+        ]
+        self.params = self.base_params
+        self.per_ip = true_value(per_ip)
+        self.user = user
+        self.proc = proc
+        # pid -> True for vsftpd processes, False for the rest.
+        self.is_vsftpd = {}
+        self.ips = None
+        
+        super(Vsftpd, self ).__init__()
+
+
+    def __titles__ (self):
+        """Process titles of the vsftpd sessions."""
+        uid = pwd.getpwnam(self.user).pw_uid
+        pids = set( name  for name in os.listdir(self.proc) if name.isdigit() )
+        for pid in set(self.is_vsftpd) - pids:
+            del self.is_vsftpd[pid]
+
+        titles = []
+        for pid in pids:
+            path = os.path.join(self.proc, pid)
+            try:
+                is_vsftpd = self.is_vsftpd.get(pid)
+                if is_vsftpd is None:
+                    comm = open(os.path.join(path, 'comm')).read()
+                    is_vsftpd = self.is_vsftpd[pid] = comm.startswith('vsftpd')
+                # vsftpd processes change owner when sessions log in.
+                if not is_vsftpd or os.stat(path).st_uid != uid:
+                    continue
+                cmdline = open(os.path.join(path, 'cmdline')).read()
+            except (IOError, OSError):
+                # Gone meanwhile.
+                continue
+            titles.append(cmdline.rstrip('\0 ').replace('\0', ' '))
+        return titles
+
+
+    def get_status (self):
+        """Retrieve data from Vsftpd.
+        """
+        
+        try:
+            titles = self.__titles__()
+        except (KeyError, OSError), err:
+            logging.warning('vsftpd: %s', err)
+            return None
+        logging.debug(titles)
+        
+        # Classify every session at once. Titles are 'vsftpd: <ip>: <data>'
+        # or 'vsftpd: <ip>/<user>: <data>'.
+        ips = set()
+        per_ip = {}
+        retr = idle = other = 0
+        for title in titles:
+            fields = title.split(': ', 2)
+            if len(fields) != 3:
+                continue
+            ip, data = fields[1:]
+            if data == 'connected':
+                ips.add(ip)
+            elif data.startswith('RETR'):
+                retr += 1
+            elif data.startswith('IDLE'):
+                idle += 1
+            else:
+                other += 1
+            if self.per_ip:
+                ip = ip.split('/')[0]
+                per_ip[ip] = per_ip.get(ip, 0) + 1
+
+        result = {
+            'vsftpd_clients': len(ips),
+            'vsftpd_data_conn_retr': retr,
+            'vsftpd_data_conn_idle': idle,
+            'vsftpd_data_conn_other': other,
+        }
+        if self.per_ip:
+            self.__update_ip_params__(per_ip)
+            for ip, count in per_ip.iteritems():
+                result['ip:' + ip] = count
+        
+        return result
+
+
+    def __update_ip_params__ (self, per_ip):
+        """Params for connections per client IP; rebuilt only if IPs change.
+        """
+        ips = frozenset(per_ip)
+        if ips == self.ips:
+            return
+        self.ips = ips
+        self.params = self.base_params + [ ('ip:' + ip,
+            'vsftpd_conn_' + re.sub('[^0-9A-Za-z]', '_', ip), 'uint16',
+            'connections', None, None, IP_DMAX)  for ip in sorted(ips) ]
+
+
+
+# Registered as the collector of this module, see gmetric_feeder.
+COLLECTOR = Vsftpd
@@ -9,11 +9,29 @@ Finally, invokes 'gmetric' to introduce the data into Ganglia.
 """
 
 
-import urllib
-from optparse import OptionParser
+import urlparse
+import re
 import subprocess
 import logging
 import copy
+import socket
+import struct
+import time
+import random
+import signal
+import heapq
+import threading
+import Queue
+import os
+import mmap
+import fcntl
+import hashlib
+import math
+import sys
+import importlib
+import itertools
+
+import gmetric_collectors
 
 
 def oneliner(cmd, stdin=None):
@@ -34,13 +52,392 @@ def oneliner(cmd, stdin=None):
 
 
 
-class GmetricSaver(object):
+def named_entries(entries, default, label=None):
+    """Parses a list of 'prefix=value' entries (a string with commas works
+    too). Returns a list of (prefix, value). Raises ValueError if two
+    entries end up with the same prefix: their data would mix.
+
+    @default:   prefix of an entry given alone without one
+    @label:     (optional) function giving the part of a value used to build
+                'default_<label>' prefixes for unnamed entries of a list
+    """
+    if isinstance(entries, basestring):
+        entries = [ e.strip()  for e in entries.split(',') if e.strip() ]
+
+    result = []
+    for entry in entries:
+        entry = str(entry)
+        if '=' in entry.split('://')[0]:
+            result.append(tuple(entry.split('=', 1)))
+        elif len(entries) == 1:
+            result.append((default, entry))
+        else:
+            text = label and label(entry) or entry
+            result.append(('%s_%s' % (default, re.sub('[^A-Za-z0-9]+', '_',
+                text).strip('_')), entry))
+
+    seen = set()
+    for prefix, entry in result:
+        if prefix in seen:
+            raise ValueError('%s: prefix %r used twice; name the entries '
+                'as prefix=value' % (entry, prefix))
+        seen.add(prefix)
+    return result
+
+
+
+# Ganglia 3.1 XDR message ids.
+GANGLIA_METADATA_FULL = 128
+GANGLIA_VALUE_STRING = 133
+
+# Ganglia slopes, as accepted by 'gmetric --slope'.
+GANGLIA_SLOPES = {'zero': 0, 'positive': 1, 'negative': 2, 'both': 3,
+    'unspecified': 4}
+
+
+def xdr_string(value):
+    """XDR-encodes a string: length, data and padding up to 4 bytes."""
+    value = str(value)
+    length = len(value)
+    return struct.pack('>I', length) + value + '\0' * (-length % 4)
+
+
+
+class Metric (object):
+    """One sample, as collectors yield it and sinks take it.
+
+    slope, tmax and dmax are left to the sink's defaults when None. host is
+    the 'ip:hostname' the metric is spoofed for; None is this host.
+    """
+
+    __slots__ = ('name', 'value', 'rrd_type', 'unit', 'slope', 'tmax', 'dmax',
+        'host')
+
+    def __init__ (self, name, value, rrd_type, unit=None, slope=None,
+            tmax=None, dmax=None, host=None):
+        self.name = name
+        self.value = value
+        self.rrd_type = rrd_type
+        self.unit = unit
+        self.slope = slope
+        self.tmax = tmax
+        self.dmax = dmax
+        self.host = host
+
+
+    def __repr__ (self):
+        return 'Metric(%r, %r, %r, %r)' % (self.name, self.value,
+            self.rrd_type, self.unit)
+
+
+
+# Layout of the metric spool: header, then a ring of records. A record is
+# its payload length and sample time, then name, value, type, unit and
+# spoofed host joined by NULs. A zero length means "continue at the start
+# of the ring".
+SPOOL_MAGIC = 'GFQ2'
+SPOOL_HEADER = struct.Struct('>4sIIIII')    # magic, size, head, tail, used,
+                                            # records
+SPOOL_RECORD = struct.Struct('>Hd')
+
+
+class MetricSpool (object):
+    """Bounded append-only ring of metrics that could not be sent, on a
+    memory-mapped file. When full, the oldest records are dropped.
+    """
+
+    def __init__ (self, path, size=4 * 1024 * 1024):
+        """Opens (creating it if needed) and locks the spool file.
+
+        %size:  (optional) bytes for records, when creating the file
+        """
+        self.path = path
+        self.file = open(path, 'a+b')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.map = None
+
+        if os.fstat(self.file.fileno()).st_size < SPOOL_HEADER.size:
+            self.__create__(size)
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            header = SPOOL_HEADER.unpack_from(self.map)
+            magic, self.size, self.head, self.tail, self.used, \
+                self.records = header
+            if magic != SPOOL_MAGIC or (len(self.map) !=
+                    SPOOL_HEADER.size + self.size):
+                logging.warning('%s: bad spool file, starting again', path)
+                self.__create__(size)
+
+
+    def __create__ (self, size):
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(0)
+        self.file.truncate(SPOOL_HEADER.size + size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = size
+        self.head = self.tail = self.used = self.records = 0
+        self.__save_header__()
+
+
+    def __save_header__ (self):
+        if not self.records:
+            self.head = self.tail = self.used = 0
+        SPOOL_HEADER.pack_into(self.map, 0, SPOOL_MAGIC, self.size, self.head,
+            self.tail, self.used, self.records)
+
+
+    def __len__ (self):
+        return self.records
+
+
+    def close (self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+    def __record_at__ (self, offset):
+        """(offset, length, stamp) of the record at or wrapped from offset.
+        """
+        if self.size - offset >= SPOOL_RECORD.size:
+            length, stamp = SPOOL_RECORD.unpack_from(self.map,
+                SPOOL_HEADER.size + offset)
+            if length:
+                return offset, length, stamp
+        # Wrapped: the rest of the ring up to its end is unused.
+        length, stamp = SPOOL_RECORD.unpack_from(self.map, SPOOL_HEADER.size)
+        return 0, length, stamp
+
+
+    def __drop_oldest__ (self):
+        offset, length, ___ = self.__record_at__(self.head)
+        end = offset + SPOOL_RECORD.size + length
+        # Bytes skipped on a wrap count as used, too.
+        self.used -= (end - self.head) % self.size or self.size
+        self.head = end
+        self.records -= 1
+
+
+    def append (self, metrics, stamp=None):
+        """Adds metrics, dropping the oldest records to make room."""
+        stamp = stamp or time.time()
+        for metric in metrics:
+            payload = '\0'.join([ metric.name, str(metric.value),
+                metric.rrd_type, metric.unit or '', metric.host or '' ])
+            needed = SPOOL_RECORD.size + len(payload)
+            if needed > self.size // 2:
+                continue
+            while True:
+                wrap = self.size - self.tail < needed
+                waste = wrap and self.size - self.tail or 0
+                if self.used + waste + needed <= self.size:
+                    break
+                self.__drop_oldest__()
+                if not self.records:
+                    self.head = self.tail = self.used = 0
+
+            if wrap:
+                if waste >= SPOOL_RECORD.size:
+                    SPOOL_RECORD.pack_into(self.map,
+                        SPOOL_HEADER.size + self.tail, 0, 0)
+                self.tail = 0
+                self.used += waste
+            offset = SPOOL_HEADER.size + self.tail
+            SPOOL_RECORD.pack_into(self.map, offset, len(payload), stamp)
+            offset += SPOOL_RECORD.size
+            self.map[offset:offset + len(payload)] = payload
+            self.tail += needed
+            self.used += needed
+            self.records += 1
+        self.__save_header__()
+
+
+    def peek (self, count):
+        """Up to count oldest records, as (stamp, Metric)."""
+        result = []
+        offset = self.head
+        for ___ in xrange(min(count, self.records)):
+            offset, length, stamp = self.__record_at__(offset)
+            start = SPOOL_HEADER.size + offset + SPOOL_RECORD.size
+            name, value, rrd_type, unit, host = self.map[start:start
+                + length].split('\0')
+            result.append((stamp, Metric(name, value, rrd_type, unit or None,
+                host=host or None)))
+            offset += SPOOL_RECORD.size + length
+        return result
+
+
+    def drop (self, count):
+        """Forgets the count oldest records."""
+        for ___ in xrange(min(count, self.records)):
+            self.__drop_oldest__()
+        self.__save_header__()
+
+
+
+class ChangeFilter (object):
+    """Holds back metrics whose value hasn't moved since it was last sent,
+    until their heartbeat is due. A value moves when it changes by more
+    than absolute, or by more than relative times the value last sent.
+
+    What was sent is remembered in memory, or on a StateFile (numbers
+    only) if state is set, so one-shot runs can suppress too.
+    """
+
+    def __init__ (self, absolute=0.0, relative=0.0):
+        self.absolute = absolute
+        self.relative = relative
+        self.sent = {}
+        self.state = None
+
+
+    def moved (self, last, value):
+        if last == value:
+            return False
+        try:
+            delta = abs(float(value) - float(last))
+        except (TypeError, ValueError):
+            return True
+        return delta > self.absolute and delta > self.relative * abs(
+            float(last))
+
+
+    def select (self, metrics, now, heartbeat):
+        """Metrics of the batch to send now, taking them as sent.
+
+        @heartbeat: function giving the seconds a metric can be held back
+        """
+        selected = []
+        sent = self.sent
+        state = self.state
+        for metric in metrics:
+            key = '%s/%s' % (metric.host or '', metric.name)
+            value = metric.value
+            number = None
+            if state is not None:
+                try:
+                    number = float(value)
+                except (TypeError, ValueError):
+                    pass
+            if number is not None:
+                last = state.get('sent/' + key)
+            else:
+                last = sent.get(key)
+            if last is not None and now - last[1] < heartbeat(metric) \
+                    and not self.moved(last[0], value):
+                continue
+            if number is not None:
+                state.put('sent/' + key, number, now)
+            else:
+                sent[key] = (value, now)
+            selected.append(metric)
+        return selected
+
+
+    def forget (self, metrics):
+        """Takes metrics as never sent, so they go on next batch."""
+        for metric in metrics:
+            key = '%s/%s' % (metric.host or '', metric.name)
+            if self.state is not None:
+                self.state.put('sent/' + key, 0, 0)
+            self.sent.pop(key, None)
+
+
+
+class Sink (object):
+    """Output backend. Takes batches of Metric records of any size.
+
+    Sinks that keep the sample time (timestamped) can be given a spool:
+    batches they can't write go there, and are replayed with their own
+    stamps once writing works again.
+    """
+
+    timestamped = False
+    # MetricSpool for batches that could not be written, if any.
+    spool = None
+    replay_batch = 500
+
+    def send (self, metrics, dry_run=False, stamp=None):
+        """Put metrics (any iterable of Metric) somewhere.
+
+        @stamp: (optional) when they were taken; now by default
+        """
+        raise NotImplementedError
+
+
+    def write (self, metrics, stamp):
+        """Writes a batch taken at stamp. True if it went through."""
+        raise NotImplementedError
+
+
+    def deliver (self, metrics, stamp):
+        """Writes a batch. Spools it if it can't, replays the spool if it
+        can."""
+        if not self.write(metrics, stamp):
+            if self.spool is not None:
+                self.spool.append(metrics, stamp)
+                logging.warning('%r: batch spooled', self)
+            else:
+                logging.warning('%r: batch dropped', self)
+            return
+        if self.spool is not None and len(self.spool):
+            self.replay()
+
+
+    def replay (self):
+        """Writes up to replay_batch spooled metrics, oldest first, every
+        one with its own stamp."""
+        records = self.spool.peek(self.replay_batch)
+        sent = 0
+        for stamp, group in itertools.groupby(records, lambda r: r[0]):
+            group = [ metric  for ___, metric in group ]
+            if not self.write(group, stamp):
+                break
+            sent += len(group)
+        self.spool.drop(sent)
+        if sent:
+            logging.info('%r: replayed %d spooled metrics, %d left', self,
+                sent, len(self.spool))
+
+
+
+class GmetricSaver(Sink):
     
     def __init__(self):
         
         # Multicast port to send/receive on.
         self.port = None
+        # Channel the metrics are sent to (gmond's udp_send_channel).
+        self.host = '239.2.11.71'
+        self.ttl = 1
+        # Identity and lifetime of the metrics, like 'gmetric' defaults.
+        self.hostname = socket.gethostname()
+        self.slope = 'both'
+        self.tmax = 60
+        self.dmax = 0
+        # Seconds between metadata packets of a metric, like gmond's
+        # send_metadata_interval. 0 sends them along every value.
+        self.meta_interval = 60
+        # Use the 'gmetric' command instead of the native sender.
+        self.use_gmetric = False
         self.template = ['gmetric','--name %s', '--value %s', '--type %s']
+
+        self.sock = None
+        self.meta_cache = {}
+        self.meta_sent = {}
+        self.value_cache = {}
+        # MetricSpool for metrics that could not be sent, if any.
+        self.spool = None
+        self.replay_batch = 500
+        # When every metric last went out live: (host, name) -> time. Only
+        # kept with a spool.
+        self.live_sent = {}
+        # ChangeFilter for values that didn't move, if any, and how long
+        # they can be held back. tmax should be twice as long: a heartbeat
+        # can go out up to a cycle late.
+        self.suppress = None
+        self.heartbeat = 300
     
     
     def __call__(self):
@@ -61,7 +458,7 @@ class GmetricSaver(object):
 
     def show (self, params, value):
         
-        data = params
+        data = list(params)
         if len(params) == 3:
             template = self.template_builder(unit=True)
         else:
@@ -70,14 +467,710 @@ class GmetricSaver(object):
         data.insert(1, value)
         return template % tuple(data)
 
+
+    def __get_socket__(self):
+        """UDP socket to the Ganglia channel. Created once and reused.
+        Raises socket.error, also if the host can't be resolved."""
+        if self.sock is None:
+            address = socket.gethostbyname(self.host)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if 224 <= int(address.split('.')[0]) <= 239:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                    self.ttl)
+            sock.connect((address, int(self.port or 8649)))
+            self.sock = sock
+        return self.sock
+
+
+    def pack_metadata(self, metric):
+        """XDR metadata packet for a metric. Cached, it never changes."""
+        key = (metric.host, metric.name, metric.rrd_type, metric.unit,
+            metric.slope, metric.tmax, metric.dmax)
+        try:
+            return self.meta_cache[key]
+        except KeyError:
+            pass
+
+        if metric.host:
+            # Like 'gmetric --spoof': the spoofed host in place of ours,
+            # the spoof flag and the SPOOF_HOST extra data.
+            host, spoof = metric.host, 1
+            extra = struct.pack('>I', 1) + xdr_string('SPOOF_HOST') \
+                + xdr_string(host)
+        else:
+            host, spoof = self.hostname, 0
+            extra = struct.pack('>I', 0)
+        packet = ''.join([
+            struct.pack('>i', GANGLIA_METADATA_FULL),
+            xdr_string(host), xdr_string(metric.name),
+            struct.pack('>i', spoof),
+            xdr_string(metric.rrd_type), xdr_string(metric.name),
+            xdr_string(metric.unit or ''),
+            struct.pack('>III', GANGLIA_SLOPES[metric.slope or self.slope],
+                metric.tmax or self.tmax, metric.dmax or self.dmax),
+            extra,
+        ])
+        self.meta_cache[key] = packet
+        return packet
+
+
+    def pack_value(self, name, value, host=None):
+        """XDR value packet for a metric, spoofed for host if given. Values
+        always go as strings, like 'gmetric' does."""
+        try:
+            header = self.value_cache[host, name]
+        except KeyError:
+            header = self.value_cache[host, name] = ''.join([
+                struct.pack('>i', GANGLIA_VALUE_STRING),
+                xdr_string(host or self.hostname), xdr_string(name),
+                struct.pack('>i', host and 1 or 0),
+                xdr_string('%s'),
+            ])
+        return header + xdr_string(value)
+
+
+    def send_gmetric(self, metrics, dry_run=False):
+        """Put metrics into Ganglia forking one 'gmetric' per metric.
+        Returns the metrics that could not be sent.
+        """
+        failed = []
+        for metric in metrics:
+            if metric.unit:
+                cmd = self.show([metric.name, metric.rrd_type, metric.unit],
+                    metric.value)
+            else:
+                cmd = self.show([metric.name, metric.rrd_type], metric.value)
+            if metric.host:
+                cmd += ' --spoof %s' % metric.host
+            logging.debug(cmd)
+            if dry_run:
+                continue
+            try:
+                if oneliner(cmd) is None:
+                    failed.append(metric)
+            except OSError:
+                failed.append(metric)
+        return failed
+
+
+    def __send_packets__(self, metrics, now, debug=False):
+        """Writes metrics to the channel. Raises socket.error."""
+        packets = []
+        meta_sent = self.meta_sent
+        for metric in metrics:
+            name = metric.name
+            host = metric.host
+            if debug:
+                logging.debug('%s%s=%s %s %s', host and host + ' ' or '', name,
+                    metric.value, metric.rrd_type, metric.unit or '')
+            if now - meta_sent.get((host, name), 0) >= self.meta_interval:
+                packets.append(self.pack_metadata(metric))
+                meta_sent[host, name] = now
+            packets.append(self.pack_value(name, metric.value, host))
+
+        try:
+            sock = self.__get_socket__()
+            for packet in packets:
+                sock.send(packet)
+        except socket.error:
+            self.sock = None
+            self.meta_sent = {}
+            raise
+
+
+    def replay(self):
+        """Sends up to replay_batch spooled metrics, oldest first. Bounded so
+        a backlog can't delay live metrics much.
+
+        Ganglia takes whatever arrives as the current value: a spooled
+        value is only replayed if it's the newest one spooled for its
+        metric and nothing newer went out live since.
+        """
+        records = self.spool.peek(self.replay_batch)
+        if not records:
+            return
+        newest = {}
+        for stamp, metric in records:
+            key = metric.host, metric.name
+            if stamp >= self.live_sent.get(key, 0):
+                newest[key] = metric
+        try:
+            self.__send_packets__(newest.values(), time.time())
+        except socket.error:
+            return
+        self.spool.drop(len(records))
+        logging.info('replayed %d spooled metrics (%d superseded), %d left',
+            len(newest), len(records) - len(newest), len(self.spool))
+
+
+    def heartbeat_of(self, metric):
+        """Seconds a metric can be held back: heartbeat, but never more
+        than half its tmax or dmax, so gmond doesn't take it as gone."""
+        beat = min(self.heartbeat, (metric.tmax or self.tmax) / 2.0)
+        dmax = metric.dmax or self.dmax
+        if dmax:
+            beat = min(beat, dmax / 2.0)
+        return beat
+
+
+    def send(self, metrics, dry_run=False, stamp=None):
+        """Put metrics into Ganglia. Packets are built here and written to
+        the channel through one UDP socket; falls back to the 'gmetric'
+        command if the socket can't be used. Metrics that can't be sent
+        either way go to the spool, if any, and are replayed later.
+        Values that didn't move are held back if suppress is set.
+        """
+        metrics = list(metrics)
+        if self.suppress is not None:
+            count = len(metrics)
+            metrics = self.suppress.select(metrics, time.time(),
+                self.heartbeat_of)
+            stats.count('suppressed', count - len(metrics))
+        if self.use_gmetric:
+            failed = self.send_gmetric(metrics, dry_run)
+        elif dry_run:
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+            for metric in metrics:
+                if debug:
+                    logging.debug('%s%s=%s %s %s',
+                        metric.host and metric.host + ' ' or '', metric.name,
+                        metric.value, metric.rrd_type, metric.unit or '')
+            return
+        else:
+            try:
+                self.__send_packets__(metrics, time.time(),
+                    logging.getLogger().isEnabledFor(logging.DEBUG))
+                failed = []
+            except socket.error, err:
+                logging.warning('native sender failed (%s), using gmetric',
+                    err)
+                failed = self.send_gmetric(metrics)
+
+        if failed and self.suppress is not None and self.spool is None:
+            self.suppress.forget(failed)
+        if self.spool is None or dry_run:
+            return
+        if failed:
+            self.spool.append(failed, stamp)
+        lost = set( (metric.host, metric.name)  for metric in failed )
+        now = time.time()
+        for metric in metrics:
+            key = metric.host, metric.name
+            if key not in lost:
+                self.live_sent[key] = now
+        if not failed and len(self.spool) and not self.use_gmetric:
+            self.replay()
+
 # Kind of singleton.
 GmetricSaver = GmetricSaver()
+gmsaver = GmetricSaver()
+
+
+
+def metric_path (metric, prefix=None):
+    """Dotted path of a metric for Graphite and StatsD:
+    '[prefix.]hostname.name', dots in the hostname turned into '_'."""
+    host = metric.host and metric.host.partition(':')[2] or gmsaver.hostname
+    path = '%s.%s' % (host.replace('.', '_'), metric.name)
+    if prefix:
+        path = '%s.%s' % (prefix, path)
+    return path
+
+
+def numeric_metrics (metrics, prefix=None):
+    """(path, value as float) of the metrics with numeric values; Graphite
+    and StatsD take nothing else."""
+    result = []
+    for metric in metrics:
+        try:
+            value = float(metric.value)
+        except (TypeError, ValueError):
+            continue
+        result.append((metric_path(metric, prefix), value))
+    return result
+
+
+
+class GraphiteSink (Sink):
+    """Sends to Carbon over one TCP connection, kept open between batches.
+    Lines of the plaintext protocol, or pickled lists of up to batch
+    metrics, as Carbon's pickle receiver takes them.
+    """
+
+    timestamped = True
+
+    def __init__ (self, host, port=None, pickle=False, prefix=None,
+            timeout=5.0, batch=1000):
+        """Initializes values.
+
+        %port:  (optional) 2003 for plaintext, 2004 for pickle by default
+        %pickle: (optional) use the pickle protocol
+        %prefix: (optional) first part of every path
+        """
+        self.host = host
+        self.port = int(port or (pickle and 2004 or 2003))
+        self.pickle = pickle
+        self.prefix = prefix
+        self.timeout = timeout
+        self.batch = batch
+        self.sock = None
+
+
+    def __repr__ (self):
+        return 'graphite%s://%s:%d' % (self.pickle and '+pickle' or '',
+            self.host, self.port)
+
+
+    def encode (self, metrics, stamp):
+        """Messages for a batch, as written to the socket."""
+        values = numeric_metrics(metrics, self.prefix)
+        stamp = int(stamp)
+        if not self.pickle:
+            return [ ''.join([ '%s %r %d\n' % (path, value, stamp)
+                for path, value in values ]) ]
+        # Imported here, like other modules not every run needs: startup is
+        # most of what a cron run costs.
+        import cPickle
+        messages = []
+        for start in xrange(0, len(values), self.batch):
+            payload = cPickle.dumps([ (path, (stamp, value))
+                for path, value in values[start:start + self.batch] ], 2)
+            messages.append(struct.pack('!L', len(payload)) + payload)
+        return messages
+
+
+    def close (self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+    def write (self, metrics, stamp):
+        """Writes the batch, reconnecting once if the connection was lost.
+        """
+        messages = self.encode(metrics, stamp)
+        for attempt in (0, 1):
+            reused = self.sock is not None
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(
+                        (self.host, self.port), self.timeout)
+                for message in messages:
+                    self.sock.sendall(message)
+                return True
+            except socket.error, err:
+                self.close()
+                if not reused or attempt:
+                    logging.warning('%r: %s', self, err)
+                    return False
+
+
+    def send (self, metrics, dry_run=False, stamp=None):
+        """Writes the batch. One that can't be written is spooled, if
+        there's a spool, or dropped."""
+        metrics = list(metrics)
+        stamp = stamp or time.time()
+        if dry_run:
+            logging.debug('%r: %d bytes', self,
+                sum(map(len, self.encode(metrics, stamp))))
+            return
+        self.deliver(metrics, stamp)
+
+
+
+class StatsdSink (Sink):
+    """Sends gauges to StatsD over UDP, as many lines per packet as fit."""
+
+    def __init__ (self, host, port=8125, prefix=None, packet_size=1432):
+        """Initializes values.
+
+        %prefix:        (optional) first part of every name
+        %packet_size:   (optional) biggest datagram, in bytes; the default
+                        fits in an Ethernet frame
+        """
+        self.host = host
+        self.port = int(port or 8125)
+        self.prefix = prefix
+        self.packet_size = packet_size
+        self.sock = None
+
+
+    def __repr__ (self):
+        return 'statsd://%s:%d' % (self.host, self.port)
+
+
+    def packets (self, metrics):
+        packets = []
+        lines = []
+        size = 0
+        for path, value in numeric_metrics(metrics, self.prefix):
+            line = '%s:%r|g' % (path, value)
+            if lines and size + 1 + len(line) > self.packet_size:
+                packets.append('\n'.join(lines))
+                lines = []
+                size = 0
+            size += len(line) + (lines and 1 or 0)
+            lines.append(line)
+        if lines:
+            packets.append('\n'.join(lines))
+        return packets
+
+
+    def send (self, metrics, dry_run=False, stamp=None):
+        packets = self.packets(metrics)
+        if dry_run:
+            logging.debug('%r: %d packets', self, len(packets))
+            return
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.connect((self.host, self.port))
+            for packet in packets:
+                self.sock.send(packet)
+        except socket.error, err:
+            self.sock = None
+            logging.warning('%r: %s; batch dropped', self, err)
+
+
+
+class JsonLinesSink (Sink):
+    """Appends metrics to a local file, one JSON object per line. The file
+    is opened on every batch, so it can be rotated away any time."""
+
+    timestamped = True
+
+    def __init__ (self, path):
+        self.path = path
+
+
+    def __repr__ (self):
+        return 'json://%s' % self.path
+
+
+    def encode (self, metrics, stamp):
+        import json
+        return [ json.dumps({'time': stamp, 'host': metric.host
+            or gmsaver.hostname, 'name': metric.name, 'value': metric.value,
+            'type': metric.rrd_type, 'unit': metric.unit},
+            sort_keys=True) + '\n'  for metric in metrics ]
+
+
+    def write (self, metrics, stamp):
+        lines = self.encode(metrics, stamp)
+        try:
+            out = open(self.path, 'a')
+            try:
+                out.writelines(lines)
+            finally:
+                out.close()
+        except IOError, err:
+            logging.warning('%r: %s', self, err)
+            return False
+        return True
+
+
+    def send (self, metrics, dry_run=False, stamp=None):
+        metrics = list(metrics)
+        stamp = stamp or time.time()
+        if dry_run:
+            logging.debug('%r: %d lines', self, len(metrics))
+            return
+        self.deliver(metrics, stamp)
+
+
+
+class SinkThread (threading.Thread):
+    """Feeds one sink from a bounded queue, so a slow sink only delays
+    itself. When the queue is full, new batches for it are dropped."""
+
+    def __init__ (self, sink, queue_size=10):
+        threading.Thread.__init__(self, name=repr(sink))
+        self.setDaemon(True)
+        self.sink = sink
+        self.queue = Queue.Queue(queue_size)
+
+
+    def run (self):
+        while True:
+            metrics, dry_run, stamp = self.queue.get()
+            try:
+                self.sink.send(metrics, dry_run, stamp)
+            except Exception:
+                logging.exception('%s: sink failed', self.name)
+            finally:
+                self.queue.task_done()
+
+
+
+class Output (Sink):
+    """Where collectors send to: every sink on the list. With one sink,
+    batches go to it right away; with more, every sink gets a SinkThread.
+    """
+
+    def __init__ (self, sinks):
+        self.sinks = sinks
+        self.threads = []
+
+
+    def set_sinks (self, sinks):
+        self.sinks = sinks
+        self.threads = []
+        if len(sinks) > 1:
+            for sink in sinks:
+                thread = SinkThread(sink)
+                thread.start()
+                self.threads.append(thread)
+
+
+    def send (self, metrics, dry_run=False, stamp=None):
+        if not self.threads:
+            for sink in self.sinks:
+                sink.send(metrics, dry_run, stamp)
+            return
+
+        # Collectors yield metrics lazily: take them once for all sinks.
+        batch = (list(metrics), dry_run, stamp or time.time())
+        for thread in self.threads:
+            try:
+                thread.queue.put_nowait(batch)
+            except Queue.Full:
+                logging.warning('%s: sink behind, batch dropped', thread.name)
+                stats.count('dropped')
+
+
+    def flush (self, timeout):
+        """Waits up to timeout seconds for the queued batches."""
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            while thread.queue.unfinished_tasks and time.time() < deadline:
+                time.sleep(0.01)
+
+
+# Kind of singleton, like GmetricSaver.
+output = Output([gmsaver])
+
+
+def build_sink (spec):
+    """Sink for a spec: 'ganglia', 'graphite://host[:port]',
+    'graphite+pickle://host[:port]', 'statsd://host[:port]' or
+    'json:///path'. Graphite and StatsD take '?prefix=...' too.
+    """
+    scheme, netloc, path, query, ___ = urlparse.urlsplit(spec)
+    options = dict(urlparse.parse_qsl(query))
+    host, ___, port = netloc.partition(':')
+    if spec == 'ganglia' or scheme == 'ganglia':
+        return gmsaver
+    elif scheme in ('graphite', 'graphite+pickle'):
+        return GraphiteSink(host, port or None, scheme == 'graphite+pickle',
+            options.get('prefix'))
+    elif scheme == 'statsd':
+        return StatsdSink(host, port or None, options.get('prefix'))
+    elif scheme == 'json':
+        return JsonLinesSink(netloc + path)
+    raise ValueError('unknown sink: %s' % spec)
+
+
+# Layout of the state file: header, then an open-addressing hash table of
+# (key hash, value, timestamp) records. A zero hash is an empty slot.
+STATE_MAGIC = 'GFS1'
+STATE_HEADER = struct.Struct('>4sII')           # magic, slots, used
+STATE_RECORD = struct.Struct('>Qdd')
+
+
+class StateFile (object):
+    """Last sample of every counter, on a memory-mapped file so one-shot
+    runs can find the samples of the previous run. Keys are stored hashed.
+
+    Records not updated for max_age seconds are dropped when the table
+    fills up, so keys that stop being used (like pids) don't pile up.
+    Collector threads can use it too: every access takes a lock.
+    """
+
+    def __init__ (self, path, slots=4096, max_age=2 * 86400):
+        """Opens (creating it if needed) and locks the state file.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.map = None
+
+        if os.fstat(self.file.fileno()).st_size < STATE_HEADER.size:
+            self.__create__(slots)
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            magic, self.slots, self.used = STATE_HEADER.unpack_from(self.map)
+            if magic != STATE_MAGIC or len(self.map) != (STATE_HEADER.size
+                    + self.slots * STATE_RECORD.size):
+                logging.warning('%s: bad state file, starting again', path)
+                self.__create__(slots)
+
+
+    def __create__ (self, slots):
+        """Empties the file, making room for slots records."""
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(0)
+        self.file.truncate(STATE_HEADER.size + slots * STATE_RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.slots = slots
+        self.used = 0
+        STATE_HEADER.pack_into(self.map, 0, STATE_MAGIC, slots, 0)
+
+
+    def close (self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+    def __key_hash__ (self, key):
+        return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+
+    def __find__ (self, khash):
+        """Offset of the record for khash, or of the empty slot for it."""
+        slot = khash % self.slots
+        while True:
+            offset = STATE_HEADER.size + slot * STATE_RECORD.size
+            found = STATE_RECORD.unpack_from(self.map, offset)[0]
+            if found == khash or found == 0:
+                return offset
+            slot = (slot + 1) % self.slots
+
+
+    def get (self, key):
+        """(value, timestamp) last stored for key, or None."""
+        khash = self.__key_hash__(key)
+        with self.lock:
+            khash, value, stamp = STATE_RECORD.unpack_from(self.map,
+                self.__find__(khash))
+        if not khash:
+            return None
+        return value, stamp
+
+
+    def put (self, key, value, stamp):
+        khash = self.__key_hash__(key)
+        with self.lock:
+            offset = self.__find__(khash)
+            if not STATE_RECORD.unpack_from(self.map, offset)[0]:
+                # Keep the table under 70% full.
+                if (self.used + 1) * 10 > self.slots * 7:
+                    self.__rebuild__()
+                    offset = self.__find__(khash)
+                self.used += 1
+                STATE_HEADER.pack_into(self.map, 0, STATE_MAGIC, self.slots,
+                    self.used)
+            STATE_RECORD.pack_into(self.map, offset, khash, value, stamp)
+
+
+    def __rebuild__ (self):
+        """Drops old records, and doubles the table if it's still more
+        than half full."""
+        oldest = time.time() - self.max_age
+        records = []
+        for slot in xrange(self.slots):
+            record = STATE_RECORD.unpack_from(self.map,
+                STATE_HEADER.size + slot * STATE_RECORD.size)
+            if record[0] and record[2] >= oldest:
+                records.append(record)
+
+        slots = self.slots
+        while (len(records) + 1) * 2 > slots:
+            slots *= 2
+        self.__create__(slots)
+        for record in records:
+            STATE_RECORD.pack_into(self.map, self.__find__(record[0]), *record)
+        self.used = len(records)
+        STATE_HEADER.pack_into(self.map, 0, STATE_MAGIC, self.slots, self.used)
+
+
+
+class RateEngine (object):
+    """Turns cumulative counters into per-second rates, remembering the last
+    sample of every counter. Samples are kept in memory, or on a StateFile
+    once open() is called.
+
+    A counter going down is taken as a restart of its source (no rate for
+    that sample), or as a wrap if it's declared 32-bit and its last value
+    was on the upper half of the 32-bit range. Rates above max_rate are
+    taken as garbage and dropped too, like rrdtool's maximum does.
+    """
+
+    def __init__ (self):
+        self.samples = {}
+        self.state = None
+        self.max_rate = 1e10
+
+
+    def open (self, path):
+        """Keep samples on a state file from now on."""
+        self.state = StateFile(path)
+
+
+    def close (self):
+        if self.state is not None:
+            self.state.close()
+            self.state = None
+
+
+    def rate (self, key, value, stamp, wrap32=False, maximum=None):
+        """Per-second rate of counter key since its last sample, or None.
+
+        @wrap32:   (optional) the counter wraps at 2**32
+        @maximum:  (optional) highest sane rate; max_rate by default
+        """
+        value = float(value)
+        if self.state is not None:
+            last = self.state.get(key)
+            self.state.put(key, value, stamp)
+        else:
+            last = self.samples.get(key)
+            self.samples[key] = (value, stamp)
+
+        if last is None or stamp <= last[1]:
+            return None
+        delta = value - last[0]
+        if delta < 0:
+            if wrap32 and 2 ** 31 <= last[0] < 2 ** 32:
+                delta += 2 ** 32
+            else:
+                return None
+        rate = delta / (stamp - last[1])
+        if rate > (maximum or self.max_rate):
+            logging.debug('%s: rate %g over the maximum, dropped', key, rate)
+            return None
+        return round(rate, 3)
+
+# Kind of singleton, like GmetricSaver.
+rates = RateEngine()
+
 
 
 class Gmetric (object):
     """Base class for retrieving data and putting it into gmetric.
     """
 
+    # Data keys (without '<prefix>:') of cumulative counters. They are sent
+    # as per-second rates. The ones wrapping at 2**32 go in counters32
+    # too; any other counter going down is taken as reset.
+    counters = frozenset()
+    counters32 = frozenset()
+    # Highest sane rate of the counters; the RateEngine's if None.
+    max_rate = None
+    # Data as last retrieved, and when. Building a collector doesn't
+    # retrieve any: refresh() does.
+    data = None
+    sampled = None
+    # Set when collectors are kept between samples (daemon mode), so they
+    # can keep incremental state.
+    long_running = False
+    # 'ip:hostname' to spoof the metrics for, when collecting from another
+    # host (like 'gmetric --spoof'). None is this host.
+    host = None
+
     def __gmetric_formated__ (self, key, name, rrd_type, unit=None):
         """Returns values formatted for gmetric (Ganglia).
         """
@@ -95,11 +1188,49 @@ class Gmetric (object):
         return gmetric_cmd
     
     
+    def prefixed_params (self, params, prefixes):
+        """Copies params for every prefix. Data is then keyed as
+        '<prefix>:<key>' and metric names start with the prefix instead of
+        their first word."""
+        result = []
+        for prefix in prefixes:
+            for param in params:
+                name = prefix + param[1][param[1].index('_'):]
+                result.append(('%s:%s' % (prefix, param[0]), name)
+                    + tuple(param[2:]))
+        return result
+
+
+    def metrics (self):
+        """Yields a Metric for every param with data. Counters go as rates.
+        """
+        if not self.data:
+            return
+
+        data = self.data
+        counters = self.counters
+        for param in self.params:
+            key = param[0]
+            if key not in data:
+                continue
+            value = data[key]
+            if counters and key.rpartition(':')[2] in counters:
+                rate_key = param[1]
+                if self.host:
+                    rate_key = '%s/%s' % (self.host, rate_key)
+                value = rates.rate(rate_key, value, self.sampled,
+                    key.rpartition(':')[2] in self.counters32, self.max_rate)
+                if value is None:
+                    continue
+            yield Metric(param[1], value, *param[2:], host=self.host)
+
+
     def __get_commands__(self):
         """Build a list of commands that should be executed to put data
         into Ganglia."""
         if self.data:
-            return [ self.__gmetric_formated__(*param)  for param in self.params]
+            return [ self.__gmetric_formated__(*param)  for param in self.params
+                if param[0] in self.data ]
         else:
             return ''
         
@@ -107,211 +1238,643 @@ class Gmetric (object):
         """Printable representation."""
         return '\n'.join(self.__get_commands__())
 
+    def refresh (self):
+        """Retrieve data (again, keeping the collector around). Returns the
+        collector."""
+        self.sampled = time.time()
+        self.data = self.get_status()
+        return self
+
+
     def save (self, dry_run=False):
         """Put data into Ganglia."""
         
-        for cmd in self.__get_commands__():
-            logging.debug(cmd)
-            if not dry_run:
-                oneliner(cmd)
+        output.send(self.metrics(), dry_run, self.sampled)
 
 
 
-class Apache (Gmetric):
-    """Gets data from Apache mod_status and digest it for gmetric.
+def true_value (value):
+    """Booleans given as strings, like ConfigParser does."""
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
 
-    Put something like this on your Apache configuration.
 
-    ExtendedStatus On
-    <Location /server-status>
-        SetHandler server-status
-        Order deny,allow
-        Deny from all
-        Allow from 127.0.0.1
-    </Location>
+
+def collector_names ():
+    """Names of the collectors there are, as used on the command line and
+    the config file: a module each on the gmetric_collectors package, which
+    registers its class as COLLECTOR. Nothing is imported to list them."""
+    names = set()
+    for path in gmetric_collectors.__path__:
+        for entry in os.listdir(path):
+            name, extension = os.path.splitext(entry)
+            if extension in ('.py', '.pyc') and not name.startswith('_'):
+                names.add(name)
+    return sorted(names)
+
+
+def collector_class (name):
+    """Class of the collector called name. Its module is imported now, the
+    first time it's needed. Raises KeyError for unknown names."""
+    if name not in collector_names():
+        raise KeyError(name)
+    return importlib.import_module('gmetric_collectors.' + name).COLLECTOR
+
+
+
+class CollectorThread (threading.Thread):
+    """Runs a collector's blocking I/O out of the main thread."""
+
+    def __init__ (self, name, func):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.func = func
+        self.result = None
+        self.failed = False
+
+
+    def run (self):
+        try:
+            self.result = self.func()
+        except Exception:
+            self.failed = True
+            logging.exception('%s: collector failed', self.name)
+
+
+
+def run_collectors (jobs):
+    """Runs jobs concurrently, each one with its own deadline. Total time
+    is bounded by the biggest deadline, not by the sum of them.
+
+    @jobs:  list of (name, function, timeout)
+
+    Returns (results, stale): results of the jobs finished in time by name,
+    and the threads of the jobs still running by name.
     """
-    
-    def __init__ (self, url=None):
-        """Initializes values.
+    start = time.time()
+    threads = []
+    for name, func, timeout in jobs:
+        thread = CollectorThread(name, func)
+        thread.start()
+        threads.append((thread, timeout))
 
-        %url: (optional)
-        """
-        
-        self.params = (
-            ( 'BytesPerSec', 'apache_bytes', 'int16', 'Bytes/sec'),
-            ( 'ReqPerSec', 'apache_hits', 'float', 'Requests/sec'),
-            ( 'BusyWorkers', 'apache_workers_busy', 'int16', 'Processes'),
-            ( 'IdleWorkers', 'apache_workers_idle', 'int16', 'Processes'),
-        )
-
-        if not url:
-            self.url = 'http://localhost/server-status/?auto'
-        else:
-            self.url = url
-            
-        self.data = self.get_status()
-        super( Apache, self ).__init__()
+    results = {}
+    stale = {}
+    for thread, timeout in threads:
+        thread.join(max(0, start + timeout - time.time()))
+        if thread.isAlive():
+            logging.warning('%s: stale, no data after %ss', thread.name,
+                timeout)
+            stale[thread.name] = thread
+        elif not thread.failed:
+            results[thread.name] = thread.result
+    return results, stale
 
-        
-    def get_status (self):
-        """Retrieve data from Apache's mod_status.
+
+
+class WorkerPool (object):
+    """A fixed number of threads running jobs from a queue, so hundreds of
+    jobs don't mean hundreds of threads. A job still running at the
+    deadline is left behind, and jobs of its name are refused until it
+    ends: one slow target can't take more than one worker.
+    """
+
+    def __init__ (self, workers):
+        self.queue = Queue.Queue()
+        self.done = threading.Condition()
+        # Names of the jobs queued or running.
+        self.busy = set()
+        for number in xrange(workers):
+            thread = threading.Thread(target=self.__work__,
+                name='worker-%d' % number)
+            thread.setDaemon(True)
+            thread.start()
+
+
+    def __work__ (self):
+        while True:
+            name, func, results = self.queue.get()
+            try:
+                result = func()
+            except Exception:
+                logging.exception('%s: collector failed', name)
+                result = None
+            with self.done:
+                results[name] = result
+                self.busy.discard(name)
+                self.done.notify()
+
+
+    def run (self, jobs, timeout):
+        """Runs jobs on the workers, waiting up to timeout seconds.
+
+        @jobs:  list of (name, function)
+
+        Returns (results, stale): results of the jobs finished in time by
+        name (None if they failed), and names of the jobs not finished or
+        refused because their last run had not finished either.
         """
-        try:
-            sock = urllib.urlopen( self.url )
-        except IOError:
-            # Unable to open a socket. Don't save any value, but keep running.
-            return None
-        page = sock.read()
-        sock.close()
-    
-        status = [line.split(': ') for line in page.splitlines()]
-        try:
-            return dict(status)
-        except ValueError:
-            # The /server-status page can not be retrieved.
-            return None
+        deadline = time.time() + timeout
+        results = {}
+        stale = []
+        queued = 0
+        with self.done:
+            for name, func in jobs:
+                if name in self.busy:
+                    logging.warning('%s: still stale, skipping', name)
+                    stale.append(name)
+                    continue
+                self.busy.add(name)
+                self.queue.put((name, func, results))
+                queued += 1
 
+            while len(results) < queued:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self.done.wait(left)
+            finished = dict(results)
 
+        for name, ___ in jobs:
+            if name not in finished and name not in stale:
+                logging.warning('%s: stale, no data after %ss', name, timeout)
+                stale.append(name)
+        return finished, stale
 
 
 
-class Mysql (Gmetric):
-    """Gets status from Mysql and digest it for gmetric.
+class Histogram (object):
+    """Samples counted on logarithmic buckets, about 19% wide, from 0.1 to
+    about 100000 milliseconds. Constant memory, whatever the samples."""
 
-    Put authentication data on '~/.my.cnf', please.
+    __slots__ = ('counts', 'count', 'total', 'max')
+    BUCKETS = 81
+
+    def __init__ (self):
+        self.reset()
+
+
+    def reset (self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add (self, ms):
+        if ms > 0.1:
+            bucket = min(int(math.log(ms / 0.1, 2) * 4) + 1, self.BUCKETS - 1)
+        else:
+            bucket = 0
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+
+    def percentile (self, fraction):
+        """Upper bound of the bucket holding that fraction of samples."""
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return round(min(0.1 * 2 ** (bucket / 4.0), self.max), 3)
+        return 0.0
+
+
+
+class FeederStats (object):
+    """What the feeder itself costs: collect, send and cycle times,
+    collector errors and other counts (metrics suppressed...). Published as
+    'feeder_*' metrics, then reset.
     """
-    
+
     def __init__ (self):
-        """Initializes values.
-        """
-        
-        # params format:
-        # (self.data[key], gmetric-type, gmetric-name, gmetric-unit)
-        self.params = (
-            ('Questions', 'mysql_queries', 'uint16', 'queries' ),
-            ('Threads_connected', 'mysql_threads_conn', 'uint16', 'threads'),
-            ('Com_select', 'mysql_select_queries', 'uint16', 'queries/sec'),
-            ('Table_locks_waited', 'mysql_table_locks_waited', 'float',
-                'locks/sec'),
-            ('Slow_queries', 'mysql_slow_queries', 'float', 'queries/sec' ),
-        )
-                   
-        self.data = self.get_status()
-        super( Mysql, self ).__init__()
+        self.timings = {}
+        self.errors = {}
+        self.counts = {}
+        # Everything is added to from collector, worker and sink threads.
+        self.lock = threading.Lock()
 
 
+    def add (self, name, ms):
+        with self.lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.add(ms)
 
-    def get_status (self):
-        """Retrieve data from Mysql's 'SHOW STATUS'.
-        """
-        
-        output = oneliner('mysql', 'SHOW STATUS')
-        if not output:
-            return None
-        
-        # Parse output into a dictionary.
-        result = {}
-        for line in output.split('\n'):
-            try:
-                key, value = line.split()
-            except ValueError:
-                key = line
-                value = ''
-            result[key] = value
-        
+
+    def error (self, collector):
+        with self.lock:
+            self.errors[collector] = self.errors.get(collector, 0) + 1
+
+
+    def count (self, name, number=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + number
+
+
+    def metrics (self):
+        """Metric for every timing (mean and 95th percentile, in ms) and
+        error count seen since last call; then forgets them."""
+        result = []
+        with self.lock:
+            for name, histogram in sorted(self.timings.items()):
+                if histogram.count:
+                    result.append(Metric('feeder_%s' % name,
+                        round(histogram.total / histogram.count, 3), 'float',
+                        'ms'))
+                    result.append(Metric('feeder_%s_p95' % name,
+                        histogram.percentile(0.95), 'float', 'ms'))
+                    histogram.reset()
+            for collector, count in sorted(self.errors.items()):
+                result.append(Metric('feeder_errors_%s' % collector, count,
+                    'uint16', 'errors'))
+            result.append(Metric('feeder_errors', sum(self.errors.values()),
+                'uint16', 'errors'))
+            self.errors = dict.fromkeys(self.errors, 0)
+            for name, count in sorted(self.counts.items()):
+                result.append(Metric('feeder_%s' % name, count, 'uint32',
+                    'metrics'))
+            self.counts = dict.fromkeys(self.counts, 0)
         return result
 
+# Kind of singleton, like GmetricSaver.
+stats = FeederStats()
 
 
-class Vsftpd(Gmetric):
-    """Gets status from Vsftpd processes and digest it for gmetric.
 
-    Set 'setproctitle_enable=YES' on your vsftpd.conf to show connection 
-    status per-process.
+def run_cycle (jobs, dry_run=False, threaded=True):
+    """One cycle: build or refresh collectors, save their data and the
+    feeder's own metrics. Every phase is timed on stats.
+
+    @jobs:      list of (name, function returning a collector, timeout)
+    @threaded:  (optional) run collectors concurrently, with deadlines
+
+    Returns the threads of collectors still running, by name.
     """
-    
-    def __init__ (self):
+    start = time.time()
+
+    def timed (name, func):
+        def job ():
+            began = time.time()
+            try:
+                return func()
+            finally:
+                stats.add('collect_ms_' + name, (time.time() - began) * 1000)
+        return job
+
+    jobs = [ (name, timed(name, func), timeout)
+        for name, func, timeout in jobs ]
+    if threaded:
+        results, stale = run_collectors(jobs)
+    else:
+        results, stale = {}, {}
+        for name, func, ___ in jobs:
+            try:
+                results[name] = func()
+            except Exception:
+                logging.exception('%s: collector failed', name)
+
+    for name, ___, ___ in jobs:
+        collector = results.get(name)
+        if collector is None or not collector.data:
+            stats.error(name)
+            continue
+        began = time.time()
+        collector.save(dry_run)
+        stats.add('send_ms', (time.time() - began) * 1000)
+
+    stats.add('cycle_ms', (time.time() - start) * 1000)
+    output.send(stats.metrics(), dry_run)
+    return stale
+
+
+
+class Daemon (object):
+    """Runs collectors forever, each one on its own interval.
+
+    Intervals are read from an INI file with one section per collector:
+
+    [apache]
+    interval = 15
+    jitter = 2
+    timeout = 5
+    url = http://localhost/server-status/?auto
+
+    The config file is read again on SIGHUP.
+    """
+
+    def __init__ (self, names, config_file=None, dry_run=False, timeout=10.0,
+            defaults=None):
         """Initializes values.
+
+        %names:         collectors to run
+        %config_file:   (optional) INI file with per-collector settings
+        %timeout:       (optional) default deadline for every collector
+        %defaults:      (optional) collector options by name, as given on
+                        the command line; the config file overrides them
         """
-        
-        self.params = (
-            ('vsftpd_clients', 'vsftpd_clients', 'uint16' ),
-            ('vsftpd_data_conn_retr', 'vsftpd_data_conn_retr', 'uint16' ),
-            ('vsftpd_data_conn_idle', 'vsftpd_data_conn_idle', 'uint16' ),
-            ('vsftpd_data_conn_other', 'vsftpd_data_conn_other', 'uint16' ),
-        )
-        
-        self.data = self.get_status()
-        super(Vsftpd, self ).__init__()
+        self.names = names
+        self.config_file = config_file
+        self.defaults = defaults or {}
+        self.dry_run = dry_run
+        self.default_interval = 60.0
+        self.default_jitter = 0.0
+        self.default_timeout = timeout
 
+        self.collectors = {}
+        self.settings = {}
+        # Threads of collectors which missed their deadline, by name.
+        self.stale = {}
+        self.reload_pending = False
+        self.load_config()
+        Gmetric.long_running = True
 
 
-    def get_status (self):
-        """Retrieve data from Vsftpd.
-        """
-        
-        output = oneliner('ps -u ftp -o cmd')
-        logging.debug(output)
-        if not output:
-            return None
-        
-        # Parse output into a dictionary.
-        result = {}
-        # Remove starting 'vsftpd: '. Resulting format: [ <ip>, <data> ]
-        conns = [ line.split(': ')[1:] for line in output.split('\n') ]
-        conns = conns[1:-1]    # Remove header and empty line.
-        
-        ips = [ ip  for ip, data in conns if data == 'connected' ]
-        result['vsftpd_clients'] = len(set(ips))
-        data_retr = [ data  for ___, data in conns if data.startswith('RETR') ]
-        result['vsftpd_data_conn_retr'] = len(data_retr)
-        data_idle = [ data  for ___, data in conns if data.startswith('IDLE') ]
-        result['vsftpd_data_conn_idle'] = len(data_idle)
-        data_other = [ data  for ___, data in conns if not data.startswith(('connected', 'RETR', 'IDLE')) ]
-        result['vsftpd_data_conn_other'] = len(data_other)
-        
-        return result
+    def load_config (self):
+        """(Re)reads the config file. Collectors are rebuilt on next tick."""
+        import ConfigParser
+        config = ConfigParser.SafeConfigParser()
+        if self.config_file:
+            config.read(self.config_file)
+
+        self.settings = {}
+        for name in self.names:
+            options = dict( (key, value)
+                for key, value in self.defaults.get(name, {}).items()
+                if value is not None )
+            if config.has_section(name):
+                options.update(config.items(name))
+            self.settings[name] = {
+                'interval': float(options.pop('interval',
+                    self.default_interval)),
+                'jitter': float(options.pop('jitter', self.default_jitter)),
+                'timeout': float(options.pop('timeout', self.default_timeout)),
+                'options': options,
+            }
+        self.collectors = {}
+
+
+    def __sighup__ (self, signum, frame):
+        self.reload_pending = True
+
+
+    def collect (self, name):
+        """Collect once. Collectors are kept between ticks."""
+        collector = self.collectors.get(name)
+        if collector is None:
+            collector = collector_class(name)(**self.settings[name]['options'])
+            self.collectors[name] = collector
+        return collector.refresh()
 
 
+    def tick (self, names):
+        """Collect concurrently and save whatever arrived in time."""
+        jobs = []
+        for name in names:
+            thread = self.stale.get(name)
+            if thread and thread.isAlive():
+                logging.warning('%s: still stale, skipping tick', name)
+                continue
+            self.stale.pop(name, None)
+            jobs.append((name, lambda name=name: self.collect(name),
+                self.settings[name]['timeout']))
 
+        self.stale.update(run_cycle(jobs, self.dry_run))
 
-class Exim (Gmetric):
-    """Parses data about Exim usage.
+
+    def next_run (self, name, slot, now):
+        """Slot of the next tick for name, and when to wake up for it.
+        Slots are one interval apart; jitter only delays the wake-up, so it
+        doesn't add up. Ticks that would have started while the last one
+        was still running are skipped."""
+        interval = self.settings[name]['interval']
+        next_slot = slot + interval
+        if next_slot < now:
+            skipped = int((now - next_slot) // interval) + 1
+            logging.warning('%s: overran, skipping %d tick(s)', name, skipped)
+            next_slot += skipped * interval
+        return (next_slot,
+            next_slot + random.uniform(0, self.settings[name]['jitter']))
+
+
+    def run (self):
+        """Main loop. Never returns."""
+        signal.signal(signal.SIGHUP, self.__sighup__)
+
+        # (wake-up time, slot, name) of every collector.
+        now = time.time()
+        queue = [ (now + random.uniform(0, self.settings[name]['jitter']),
+            now, name)  for name in self.names ]
+        heapq.heapify(queue)
+
+        while True:
+            if self.reload_pending:
+                logging.info('SIGHUP received, reloading %s', self.config_file)
+                self.reload_pending = False
+                self.load_config()
+
+            delay = queue[0][0] - time.time()
+            if delay > 0:
+                # Wakes up early on signals; loop again to check them.
+                time.sleep(delay)
+                continue
+
+            # Every collector due now runs in the same tick.
+            due = []
+            while queue and queue[0][0] <= time.time():
+                due.append(heapq.heappop(queue))
+            self.tick([ name  for ___, ___, name in due ])
+
+            now = time.time()
+            for ___, slot, name in due:
+                slot, wake = self.next_run(name, slot, now)
+                heapq.heappush(queue, (wake, slot, name))
+
+
+
+# Collectors that can work against another host.
+REMOTE_COLLECTORS = {
+    'apache': ('url', 'http://%s/server-status/?auto'),
+    'mysql': ('instance', '%s:3306'),
+}
+
+
+def spoof_host (host):
+    """'ip:hostname' for host, as 'gmetric --spoof' takes it."""
+    if ':' in host:
+        return host
+    try:
+        address = socket.gethostbyname(host)
+    except socket.error, err:
+        logging.warning('%s: %s; spoofing by name', host, err)
+        address = host
+    return '%s:%s' % (address, host)
+
+
+class Agentless (object):
+    """Collects from the hosts on a targets file, so they don't need a
+    feeder of their own. Metrics are sent on their behalf, as
+    'gmetric --spoof' would.
+
+    One target per line: host, collector and options as name=value.
+    Without options, the host's default status URL or MySQL port is used.
+
+    # host          collector   options
+    web1.example    apache
+    web2.example    apache      url=http://web2.example:8080/status?auto
+    db1.example     mysql       instance=db1.example:3307 timeout=3
+    10.0.0.5:db2    mysql
+
+    Targets are collected on a fixed number of worker threads. Each one
+    has its own timeout, and a target still running when the next cycle
+    comes is skipped: slow hosts don't delay the others.
+    The targets file is read again on SIGHUP.
     """
-    
-    def __init__ (self):
+
+    def __init__ (self, targets_file, workers=32, dry_run=False,
+            timeout=10.0, interval=60.0):
         """Initializes values.
 
-        %params: fields from Exim we want to get.
+        %targets_file:  file listing the targets
+        %workers:       (optional) targets collected at once
+        %timeout:       (optional) default network timeout of a target
+        %interval:      (optional) seconds between cycles; also the
+                        deadline of a cycle
         """
-        
-        self.params = (
-            ( 'exim_incoming_queue', 'exim_incoming_queue', 'int16', 'messages'),
-            ( 'exim_outgoing_queue', 'exim_outgoing_queue', 'int16', 'messages'),
-        )
+        self.targets_file = targets_file
+        self.dry_run = dry_run
+        self.timeout = timeout
+        self.interval = interval
+        self.pool = WorkerPool(workers)
+        self.targets = {}
+        self.collectors = {}
+        self.reload_pending = False
+        self.load_targets()
 
-        self.data = self.get_status()
-        super( Exim, self ).__init__()
 
-        
-    def get_status (self):
-        result = {}
-        try:
-            # Remove the trailing '\n.
-            result['exim_incoming_queue'] = oneliner('/usr/sbin/exim -bpc')[:-1]
-            result['exim_outgoing_queue'] = oneliner('/usr/sbin/exim -bpc -DOUTGOING')[:-1]
-        except OSError:
-            return None
+    def load_targets (self):
+        """(Re)reads the targets file. Collectors are rebuilt on next
+        cycle."""
+        targets = {}
+        for number, line in enumerate(open(self.targets_file), 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) < 2 or fields[1] not in REMOTE_COLLECTORS:
+                logging.warning('%s:%d: bad target, ignored',
+                    self.targets_file, number)
+                continue
+            host, kind = fields[:2]
+            name = '%s/%s' % (host, kind)
+            if name in targets:
+                logging.warning('%s:%d: %s listed twice, ignored',
+                    self.targets_file, number, name)
+                continue
+            try:
+                options = dict( option.split('=', 1)
+                    for option in fields[2:] )
+            except ValueError:
+                logging.warning('%s:%d: bad options, ignored',
+                    self.targets_file, number)
+                continue
+            key, default = REMOTE_COLLECTORS[kind]
+            options.setdefault(key, default % host.partition(':')[0])
+            timeout = float(options.pop('timeout', self.timeout))
+            if kind == 'apache':
+                options.setdefault('connect_timeout', min(timeout, 2.0))
+                options.setdefault('read_timeout', timeout)
+            else:
+                options.setdefault('connect_timeout', timeout)
+            targets[name] = (host, kind, options)
+        logging.info('%s: %d targets', self.targets_file, len(targets))
+        self.targets = targets
+        self.collectors = {}
+
+
+    def __sighup__ (self, signum, frame):
+        self.reload_pending = True
+
+
+    def collect (self, name):
+        """Collect once from a target. Runs on a worker."""
+        began = time.time()
+        # Kept apart: a reload while this runs starts a new dictionary.
+        collectors = self.collectors
+        collector = collectors.get(name)
+        if collector is None:
+            host, kind, options = self.targets[name]
+            collector = collector_class(kind)(**options)
+            collector.host = spoof_host(host)
+            collectors[name] = collector
+        collector.refresh()
+        stats.add('collect_ms_agentless', (time.time() - began) * 1000)
+        return collector
 
-        return result
 
+    def cycle (self):
+        """Collect from every target and save whatever arrived in time."""
+        start = time.time()
+        results, stale = self.pool.run([ (name,
+            lambda name=name: self.collect(name))
+            for name in sorted(self.targets) ], self.interval)
 
+        for name in sorted(self.targets):
+            collector = results.get(name)
+            if collector is None or not collector.data:
+                stats.error('agentless')
+                continue
+            began = time.time()
+            collector.save(self.dry_run)
+            stats.add('send_ms', (time.time() - began) * 1000)
+
+        stats.add('cycle_ms', (time.time() - start) * 1000)
+        output.send(stats.metrics(), self.dry_run)
+        logging.debug('%d targets, %d stale, %.3fs', len(self.targets),
+            len(stale), time.time() - start)
+
+
+    def run (self):
+        """Main loop. Never returns."""
+        signal.signal(signal.SIGHUP, self.__sighup__)
+        Gmetric.long_running = True
+        next_time = time.time()
+        while True:
+            if self.reload_pending:
+                logging.info('SIGHUP received, reloading %s',
+                    self.targets_file)
+                self.reload_pending = False
+                self.load_targets()
+
+            delay = next_time - time.time()
+            if delay > 0:
+                # Wakes up early on signals; loop again to check them.
+                time.sleep(delay)
+                continue
+
+            self.cycle()
+            next_time += self.interval
+            now = time.time()
+            if next_time < now:
+                skipped = int((now - next_time) // self.interval) + 1
+                logging.warning('agentless: overran, skipping %d cycle(s)',
+                    skipped)
+                next_time += skipped * self.interval
 
 
 
 
 if __name__ == "__main__":
 
+    # Run as a script, this module is '__main__'. Collector modules must get
+    # it, and not a second copy, when they import gmetric_feeder.
+    sys.modules['gmetric_feeder'] = sys.modules['__main__']
+    from optparse import OptionParser
+
     # Parse command-line.
     usage = """usage: %prog [options]"""
     parser = OptionParser(usage=usage)
@@ -322,14 +1885,76 @@ if __name__ == "__main__":
                       help="do nothing; just show", dest="dry_run")
     parser.add_option("-p", "--port", action="store",
                       help="multicast port for Ganglia")
+    parser.add_option("-H", "--host", action="store",
+                      help="multicast group or gmond host for Ganglia")
+    parser.add_option("-g", "--gmetric", action="store_true",
+                      help="send through the 'gmetric' command", dest="gmetric")
     parser.add_option("-a", "--apache", action="store_true",
                       help="Apache mod_status")
+    parser.add_option("-u", "--url", action="append",
+                      help="Apache status URL, as [prefix=]URL; repeatable")
     parser.add_option("-m", "--mysql", action="store_true",
-                      help="Mysql SHOW STATUS")
+                      help="Mysql SHOW GLOBAL STATUS")
+    parser.add_option("-i", "--mysql-instance", action="append",
+                      help="Mysql socket, [host:]port or prefix=...; repeatable")
+    parser.add_option("--mysql-allow", action="append",
+                      help="regexp of Mysql status variables to export too")
+    parser.add_option("--mysql-deny", action="append",
+                      help="regexp of Mysql status variables not to export")
     parser.add_option("-f", "--vsftpd", action="store_true",
                       help="vsftpd status")
+    parser.add_option("--vsftpd-per-ip", action="store_true",
+                      help="vsftpd connections per client IP too")
     parser.add_option("-e", "--exim", action="store_true",
                       help="Exim status")
+    parser.add_option("--exim-ages", action="store_true",
+                      help="Exim queue age histograms too")
+    parser.add_option("-P", "--procs", action="store_true",
+                      help="CPU, memory, fds and I/O of every service")
+    parser.add_option("--procs-pss", action="store_true",
+                      help="proportional memory of every service too")
+    parser.add_option("-C", "--collect", action="append", default=[],
+                      help="collectors to run, by name (%s); repeatable" %
+                      ', '.join(collector_names()))
+    parser.add_option("-O", "--option", action="append", default=[],
+                      help="collector option, as name.option=value; "
+                      "repeatable")
+    parser.add_option("-d", "--daemon", action="store_true",
+                      help="keep running, collecting on intervals")
+    parser.add_option("--profile", action="store_true",
+                      help="profile one cycle; report on stderr")
+    parser.add_option("-c", "--config", action="store",
+                      help="config file with per-collector settings")
+    parser.add_option("-s", "--state", action="store",
+                      default="/var/tmp/gmetric_feeder.state",
+                      help="file keeping counters between runs")
+    parser.add_option("--spool", action="store",
+                      help="file keeping metrics that could not be sent; "
+                      "Graphite and JSON sinks add their name to it")
+    parser.add_option("--spool-size", action="store", type="int",
+                      default=4096, help="spool size, in KB")
+    parser.add_option("-t", "--timeout", action="store", type="float",
+                      default=10.0, help="seconds to wait for every collector")
+    parser.add_option("-T", "--targets", action="store",
+                      help="file of remote hosts to collect from, spoofing; "
+                      "no local collectors then")
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      default=32, help="targets collected at once")
+    parser.add_option("--interval", action="store", type="float",
+                      default=60.0, help="seconds between target cycles")
+    parser.add_option("-o", "--sink", action="append",
+                      help="where to send: ganglia (default), "
+                      "graphite[+pickle]://host[:port][?prefix=...], "
+                      "statsd://host[:port][?prefix=...] or json:///path; "
+                      "repeatable")
+    parser.add_option("--heartbeat", action="store", type="float",
+                      help="hold back values that didn't move, sending them "
+                      "again after this many seconds")
+    parser.add_option("--suppress-abs", action="store", type="float",
+                      default=0.0, help="changes up to this are no move")
+    parser.add_option("--suppress-rel", action="store", type="float",
+                      default=0.0,
+                      help="changes up to this fraction are no move")
 
     
     opts, ___ = parser.parse_args()
@@ -343,13 +1968,108 @@ if __name__ == "__main__":
     gmsaver = GmetricSaver()
     if opts.port:
         gmsaver.port = opts.port
+    if opts.host:
+        gmsaver.host = opts.host
+    gmsaver.use_gmetric = opts.gmetric
+    if opts.sink:
+        try:
+            output.set_sinks([ build_sink(spec)  for spec in opts.sink ])
+        except ValueError, err:
+            parser.error(str(err))
+    if opts.heartbeat:
+        gmsaver.suppress = ChangeFilter(opts.suppress_abs, opts.suppress_rel)
+        gmsaver.heartbeat = opts.heartbeat
+        gmsaver.tmax = max(gmsaver.tmax, int(2 * opts.heartbeat))
+    # One spool per sink that can replay: Ganglia (newest values only) and
+    # those keeping sample times.
+    if opts.spool and not opts.dry_run:
+        for sink in output.sinks:
+            if sink is gmsaver:
+                path = opts.spool
+            elif sink.timestamped:
+                path = '%s.%s' % (opts.spool,
+                    re.sub('[^A-Za-z0-9]+', '_', repr(sink)).strip('_'))
+            else:
+                continue
+            try:
+                sink.spool = MetricSpool(path, opts.spool_size * 1024)
+            except (IOError, OSError), err:
+                logging.warning('%s: %s; not spooling', path, err)
     
-    # TODO: add --url for Apache().
-    if opts.apache:
-        Apache().save(opts.dry_run)
-    if opts.mysql:
-        Mysql().save(opts.dry_run)
-    if opts.vsftpd:
-        Vsftpd().save(opts.dry_run)
-    if opts.exim:
-        Exim().save(opts.dry_run)
+    # Collectors by name, and by their own flags.
+    names = set( name.strip()  for names in opts.collect
+        for name in names.split(',') if name.strip() )
+    names.update( name  for name in collector_names()
+        if getattr(opts, name, False) )
+    unknown = names - set(collector_names())
+    if unknown:
+        parser.error('unknown collector: %s' % ', '.join(sorted(unknown)))
+    names = sorted(names)
+    if opts.targets and names:
+        parser.error('-T collects the targets only, not %s' % ', '.join(names))
+
+    # Options of the collectors: their own flags, then --option.
+    options = {
+        'apache': {'url': opts.url},
+        'mysql': {'instance': opts.mysql_instance, 'allow': opts.mysql_allow,
+            'deny': opts.mysql_deny},
+        'vsftpd': {'per_ip': opts.vsftpd_per_ip},
+        'exim': {'ages': opts.exim_ages},
+        'procs': {'pss': opts.procs_pss},
+    }
+    for option in opts.option:
+        try:
+            key, value = option.split('=', 1)
+            name, key = key.split('.', 1)
+        except ValueError:
+            parser.error('bad collector option: %s' % option)
+        options.setdefault(name, {})[key] = value
+
+    if opts.targets:
+        agentless = Agentless(opts.targets, opts.workers, opts.dry_run,
+            opts.timeout, opts.interval)
+        if opts.daemon:
+            agentless.run()
+    elif opts.daemon and not opts.profile:
+        Daemon(names, opts.config, opts.dry_run, opts.timeout,
+            options).run()
+
+    # Counters of the previous run. Dry runs don't touch them.
+    if not opts.dry_run:
+        try:
+            rates.open(opts.state)
+            if gmsaver.suppress is not None:
+                gmsaver.suppress.state = rates.state
+        except (IOError, OSError), err:
+            logging.warning('%s: %s; no rates this run', opts.state, err)
+
+    # Build every collector (importing its module), then collect.
+    jobs = []
+    for name in names:
+        try:
+            collector = collector_class(name)(**dict( (key, value)
+                for key, value in options.get(name, {}).items()
+                if value is not None ))
+        except Exception:
+            logging.exception('%s: collector failed', name)
+            stats.error(name)
+            continue
+        jobs.append((name, collector.refresh, opts.timeout))
+
+    if opts.targets:
+        agentless.cycle()
+    elif opts.profile:
+        import cProfile
+        import pstats
+        # cProfile only sees the main thread: collect without threads.
+        profiler = cProfile.Profile()
+        profiler.runcall(run_cycle, jobs, opts.dry_run, False)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(40)
+    else:
+        run_cycle(jobs, opts.dry_run)
+    output.flush(opts.timeout)
+    rates.close()
+    for sink in output.sinks:
+        if sink.spool is not None:
+            sink.spool.close()
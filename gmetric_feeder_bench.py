@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# gmetric_feeder_bench.py
+# -*- coding: utf-8 -*-
+#
+# Jordi Funollet <jordi.f@ati.es>
+
+"""Benchmarks for gmetric_feeder.py hot paths. Needs no live services:
+Apache, MySQL, vsftpd and Exim are replaced by local stand-ins (a fake
+/server-status server, canned 'SHOW STATUS' output, a synthetic /proc tree
+and a synthetic Exim spool).
+
+Every result is milliseconds per operation, lower is better. Results can be
+saved as a baseline and later runs compared against it:
+
+    gmetric_feeder_bench.py --save baseline.json
+    gmetric_feeder_bench.py --baseline baseline.json
+
+Exits with status 1 if something got slower than the baseline allows.
+"""
+
+
+import BaseHTTPServer
+import SocketServer
+import logging
+import os
+import pwd
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import gmetric_feeder
+import gmetric_collectors.apache
+import gmetric_collectors.exim
+import gmetric_collectors.mysql
+import gmetric_collectors.procs
+import gmetric_collectors.vsftpd
+from bench_util import add_baseline_options, per_round, report
+
+
+def fake_metrics(count):
+    """List of Metric records."""
+    return [ gmetric_feeder.Metric('bench_metric_%d' % i, i, 'uint32',
+        'things')  for i in range(count) ]
+
+
+
+def canned_status(count):
+    """'SHOW STATUS' output of the 'mysql' client with count variables."""
+    families = ['Com_', 'Handler_', 'Innodb_buffer_pool_pages_',
+        'Innodb_rows_', 'Innodb_buffer_pool_read_', 'Select_', 'Created_']
+    lines = ['Variable_name\tValue', 'Questions\t123456789',
+        'Threads_connected\t42', 'Com_select\t98765432',
+        'Table_locks_waited\t12', 'Slow_queries\t345']
+    for i in range(count - 5):
+        lines.append('%svar_%d\t%d' % (families[i % len(families)], i,
+            i * 7919))
+    return '\n'.join(lines) + '\n'
+
+
+
+def canned_server_status(slots):
+    """'/server-status?auto' page of an Apache with that many slots."""
+    scoreboard = ('_' * 4 + 'W' * 3 + 'K' * 2 + 'R' + '.' * 6) * (slots // 16)
+    return '\n'.join([
+        'Total Accesses: 123456789', 'Total kBytes: 987654321',
+        'CPULoad: .123', 'Uptime: 1234567', 'ReqPerSec: 100.5',
+        'BytesPerSec: 819200', 'BytesPerReq: 8151.2',
+        'BusyWorkers: %d' % scoreboard.count('W'),
+        'IdleWorkers: %d' % scoreboard.count('_'),
+        'Scoreboard: %s' % scoreboard, '' ])
+
+
+
+def local_sink():
+    """UDP socket on localhost. The saver is pointed to it."""
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    saver = gmetric_feeder.gmsaver
+    saver.host, saver.port = sink.getsockname()
+    saver.sock = None
+    return sink
+
+
+
+class StatusHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the same '?auto' page for any path, keeping connections."""
+
+    protocol_version = 'HTTP/1.1'
+    # Whole responses in one write, like Apache does.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    page = canned_server_status(256)
+
+    def do_GET (self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message (self, *args):
+        pass
+
+
+
+class StatusServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+
+def fake_proc(root, sessions, others):
+    """Synthetic /proc with vsftpd sessions and other processes."""
+    states = ['connected', 'IDLE', 'RETR /pub/file.iso', 'STOR upload.bin']
+    for pid in xrange(1000, 1000 + sessions + others):
+        path = os.path.join(root, str(pid))
+        os.mkdir(path)
+        if pid - 1000 < sessions:
+            comm = 'vsftpd\n'
+            title = 'vsftpd: 10.0.%d.%d/user: %s' % (pid % 250, pid % 200,
+                states[pid % len(states)])
+        else:
+            comm = 'httpd\n'
+            title = '/usr/sbin/httpd\0-k\0start'
+        open(os.path.join(path, 'comm'), 'w').write(comm)
+        open(os.path.join(path, 'cmdline'), 'w').write(title + '\0')
+
+
+
+def fake_proc_tree(root, children, others):
+    """Synthetic /proc with an Apache parent, its children and other
+    processes: 'stat', 'io' and a few entries on 'fd' each."""
+    for pid in xrange(2, 2 + children + others):
+        path = os.path.join(root, str(pid))
+        os.makedirs(os.path.join(path, 'fd'))
+        if pid - 2 <= children:
+            comm, ppid = 'apache2', pid > 2 and 2 or 1
+        else:
+            comm, ppid = 'bash', 1
+        # Fields: pid (comm) state ppid ... utime stime ... threads ...
+        # starttime vsize rss
+        fields = [ '0' ] * 49
+        fields[0:4] = [ str(pid), '(%s)' % comm, 'S', str(ppid) ]
+        fields[13:15] = [ str(pid % 500), str(pid % 70) ]
+        fields[19] = '1'
+        fields[21] = str(1000 + pid)
+        fields[23] = str(2000 + pid % 300)
+        open(os.path.join(path, 'stat'), 'w').write(' '.join(fields) + '\n')
+        open(os.path.join(path, 'io'), 'w').write('rchar: 1\nwchar: 1\n'
+            'read_bytes: %d\nwrite_bytes: %d\n' % (pid * 4096, pid * 512))
+        for fd in range(4):
+            open(os.path.join(path, 'fd', str(fd)), 'w').close()
+
+
+
+def fake_spool(root, messages):
+    """Synthetic split Exim spool with that many messages."""
+    chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    now = int(time.time())
+    for i in xrange(messages):
+        stamp = now - i
+        msgid = ''
+        for ___ in range(6):
+            msgid = chars[stamp % 62] + msgid
+            stamp //= 62
+        msgid += '-%06d-%s' % (i % 1000000, chars[i % 62] * 2)
+        subdir = os.path.join(root, 'input', msgid[5])
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        open(os.path.join(subdir, msgid + '-H'), 'w').close()
+        open(os.path.join(subdir, msgid + '-D'), 'w').close()
+
+
+
+def bench_sender(metrics_count, rounds, fork=True):
+    """The native sender against the fork path, per metric.
+
+    The fork path runs '/bin/true' instead of 'gmetric' when the latter is
+    not installed, so only the fork+exec cost is measured.
+    """
+    saver = gmetric_feeder.gmsaver
+    metrics = fake_metrics(metrics_count)
+    results = [('send_native_per_metric',
+        per_round(lambda: saver.send(metrics), rounds) / metrics_count)]
+    # Encoding only: no Carbon or StatsD around to take them.
+    now = time.time()
+    for sink in (gmetric_feeder.GraphiteSink('127.0.0.1'),
+            gmetric_feeder.GraphiteSink('127.0.0.1', pickle=True)):
+        results.append(('encode_%s_per_metric' % (sink.pickle and 'pickle'
+            or 'graphite'), per_round(lambda: sink.encode(metrics, now),
+            rounds) / metrics_count))
+    statsd = gmetric_feeder.StatsdSink('127.0.0.1')
+    results.append(('encode_statsd_per_metric',
+        per_round(lambda: statsd.packets(metrics), rounds) / metrics_count))
+
+    if fork:
+        template = saver.template
+        if not [ d for d in os.environ['PATH'].split(':')
+                if os.path.exists(os.path.join(d, 'gmetric')) ]:
+            saver.template = ['/bin/true'] + saver.template[1:]
+        # Forking is slow: a few metrics are enough.
+        results.append(('send_fork_per_metric',
+            per_round(lambda: saver.send_gmetric(metrics[:20]), 1) / 20))
+        saver.template = template
+    return results
+
+
+
+def bench_apache(endpoints, rounds):
+    """Scraping many endpoints on a local fake server."""
+    server = StatusServer(('127.0.0.1', 0), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    url = 'http://127.0.0.1:%d/server-status?auto' % server.server_address[1]
+    apache = gmetric_collectors.apache.Apache([ 'ep%d=%s' % (i, url)
+        for i in range(endpoints) ]).refresh()
+    page = canned_server_status(10240)
+    results = [
+        ('apache_parse_page_10k_slots',
+            per_round(lambda: apache.parse(page), rounds)),
+        ('apache_collect_%d_endpoints' % endpoints,
+            per_round(apache.refresh, rounds)),
+        ('apache_send_%d_endpoints' % endpoints,
+            per_round(apache.save, rounds)),
+    ]
+    for prefix, ___ in apache.endpoints:
+        apache.pool.drop(prefix)
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+
+def bench_mysql(variables, rounds):
+    """Parse, export and send a full 'SHOW STATUS' dump, per cycle."""
+    output = canned_status(variables)
+
+    parse_status = gmetric_collectors.mysql.parse_status
+
+    class CannedMysql (gmetric_collectors.mysql.Mysql):
+        def status_cli (self, instance):
+            return parse_status(output)
+
+    # Always the 'mysql' client path, with canned output.
+    gmetric_collectors.mysql.MySQLdb = None
+    mysql = CannedMysql(allow='.*', deny='Com_stmt_.*').refresh()
+    mysql.save()
+
+    def cycle():
+        mysql.refresh()
+        mysql.save()
+
+    return [
+        ('mysql_parse_%d_vars' % variables,
+            per_round(lambda: parse_status(output), rounds)),
+        ('mysql_collect_%d_vars' % variables,
+            per_round(mysql.refresh, rounds)),
+        ('mysql_cycle_%d_vars' % variables, per_round(cycle, rounds)),
+    ]
+
+
+
+def bench_vsftpd(tmpdir, sessions, rounds):
+    """Sessions on a synthetic /proc with as many other processes."""
+    root = os.path.join(tmpdir, 'proc')
+    os.mkdir(root)
+    fake_proc(root, sessions, sessions)
+
+    user = pwd.getpwuid(os.getuid()).pw_name
+    start = time.time()
+    vsftpd = gmetric_collectors.vsftpd.Vsftpd(per_ip=True, user=user,
+        proc=root).refresh()
+    cold = (time.time() - start) * 1000
+    return [
+        ('vsftpd_collect_%d_sessions_cold' % sessions, cold),
+        ('vsftpd_collect_%d_sessions' % sessions,
+            per_round(vsftpd.refresh, rounds)),
+        ('vsftpd_send_%d_sessions' % sessions,
+            per_round(vsftpd.save, rounds)),
+    ]
+
+
+
+def bench_procs(tmpdir, children, rounds):
+    """Services' resources on a synthetic /proc, that many Apache children
+    and as many other processes."""
+    root = os.path.join(tmpdir, 'proctree')
+    fake_proc_tree(root, children, children)
+
+    Processes = gmetric_collectors.procs.Processes
+    start = time.time()
+    procs = Processes(proc=root).refresh()
+    cold = (time.time() - start) * 1000
+    stat_only = Processes(fds=False, io=False, proc=root).refresh()
+    results = [
+        ('procs_collect_%d_children_cold' % children, cold),
+        ('procs_collect_%d_children' % children,
+            per_round(procs.refresh, rounds)),
+        ('procs_collect_%d_children_stat_only' % children,
+            per_round(stat_only.refresh, rounds)),
+    ]
+
+    # A cron run: a new collector, sums kept next to the state file.
+    gmetric_feeder.rates.open(os.path.join(tmpdir, 'procs.state'))
+    try:
+        results.append(('procs_collect_%d_children_one_shot' % children,
+            per_round(lambda: Processes(proc=root).refresh(), rounds)))
+    finally:
+        gmetric_feeder.rates.close()
+    return results
+
+
+
+def bench_exim(tmpdir, messages, rounds):
+    """Queues on a synthetic spool, rescanned and watched."""
+    spool = os.path.join(tmpdir, 'spool')
+    fake_spool(spool, messages)
+
+    Exim = gmetric_collectors.exim.Exim
+    exim = Exim(spool, spool, ages=True)
+    scan = per_round(exim.refresh, max(rounds // 10, 1))
+
+    gmetric_feeder.Gmetric.long_running = True
+    try:
+        watched = Exim(spool, spool).refresh()
+    finally:
+        gmetric_feeder.Gmetric.long_running = False
+    return [
+        ('exim_scan_%d_messages' % messages, scan),
+        ('exim_watched_%d_messages' % messages,
+            per_round(watched.refresh, rounds)),
+        ('exim_ages_%d_messages' % messages, per_round(
+            lambda: exim.queues['incoming'].ages(time.time()),
+            max(rounds // 10, 1))),
+    ]
+
+
+
+def bench_startup(rounds):
+    """What a cron run pays before collecting anything: the interpreter,
+    then importing the feeder, then importing a collector's module."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    def run(code):
+        return per_round(lambda: subprocess.check_call([sys.executable, '-c',
+            code], cwd=here), rounds)
+
+    python = run('pass')
+    feeder = run('import gmetric_feeder')
+    results = [
+        ('startup_python', python),
+        ('startup_import_feeder', feeder - python),
+    ]
+    for name in gmetric_feeder.collector_names():
+        # Cheap modules are lost in the noise: no negative times.
+        results.append(('startup_import_%s' % name, max(run('import '
+            'gmetric_feeder; gmetric_feeder.collector_class(%r)' % name)
+            - feeder, 0.0)))
+    return results
+
+
+
+if __name__ == "__main__":
+
+    usage = """usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-m", "--metrics", action="store", type="int",
+                      default=100, help="metrics per send")
+    parser.add_option("-r", "--rounds", action="store", type="int",
+                      default=100, help="rounds for every benchmark")
+    parser.add_option("-s", "--status-vars", action="store", type="int",
+                      default=500, help="variables on 'SHOW STATUS'")
+    parser.add_option("-e", "--endpoints", action="store", type="int",
+                      default=20, help="Apache status endpoints")
+    parser.add_option("-f", "--sessions", action="store", type="int",
+                      default=10000, help="vsftpd sessions on the fake /proc")
+    parser.add_option("-c", "--children", action="store", type="int",
+                      default=2000, help="Apache children on the fake /proc")
+    parser.add_option("-q", "--messages", action="store", type="int",
+                      default=100000, help="messages on the fake Exim spool")
+    parser.add_option("--no-fork", action="store_false", dest="fork",
+                      default=True, help="skip the gmetric fork benchmark")
+    add_baseline_options(parser)
+    opts, ___ = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # Packets don't leave the host.
+    sink = local_sink()
+    tmpdir = tempfile.mkdtemp(prefix='gmetric_feeder_bench.')
+    try:
+        results = bench_startup(max(opts.rounds // 10, 1))
+        results += bench_sender(opts.metrics, opts.rounds, opts.fork)
+        results += bench_apache(opts.endpoints, opts.rounds)
+        results += bench_mysql(100, opts.rounds)
+        results += bench_mysql(opts.status_vars, opts.rounds)
+        results += bench_vsftpd(tmpdir, opts.sessions, max(opts.rounds // 10, 1))
+        results += bench_procs(tmpdir, opts.children, max(opts.rounds // 10, 1))
+        results += bench_exim(tmpdir, opts.messages, opts.rounds)
+    finally:
+        shutil.rmtree(tmpdir)
+        sink.close()
+
+    report(results, opts)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# keep_an_eye_on.py
+# -*- coding: utf-8 -*-
+
+"""Waits for processes to finish, then tells: mail, a Ganglia metric and
+optionally an event on Ganglia's web frontend.
+
+Like 'keep-an-eye-on', but for any number of processes at once and without
+polling: every process is watched through a pidfd on one epoll set, so an
+exit is seen right away and waiting costs nothing. Kernels without
+pidfd_open (before 5.3) fall back to checking on an interval.
+
+    keep_an_eye_on.py --mail me@example.org 1234 'rsync.*backup'
+
+A target is a PID or a regexp matched against process names (against the
+whole command line with --full), like 'pgrep' does. A pattern is finished
+when no process matches it any more: /proc is scanned again when the last
+one seen exits, so processes started meanwhile are waited for too.
+"""
+
+
+import ctypes
+import errno
+import logging
+import os
+import re
+import select
+import socket
+import subprocess
+import time
+import urllib
+import urllib2
+from optparse import OptionParser
+
+import gmetric_feeder
+from gmetric_feeder import Metric
+
+
+# pidfd_open(2) syscall number, on every architecture but alpha.
+SYS_PIDFD_OPEN = 434
+
+
+
+class PidfdWatch (object):
+    """Processes watched through pidfds on one epoll set. A pidfd turns
+    readable when its process exits."""
+
+    def __init__ (self):
+        """Raises OSError (ENOSYS) if the kernel has no pidfd_open."""
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.epoll = select.epoll()
+        # fd -> pid
+        self.fds = {}
+        probe = self.__open__(os.getpid())
+        os.close(probe)
+
+
+    def __open__ (self, pid):
+        fd = self.libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return fd
+
+
+    def add (self, pid):
+        """Starts watching pid. False if it's gone already."""
+        try:
+            fd = self.__open__(pid)
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                return False
+            raise
+        self.fds[fd] = pid
+        self.epoll.register(fd, select.EPOLLIN)
+        return True
+
+
+    def wait (self):
+        """Blocks until some watched process exits. Returns their pids."""
+        while True:
+            try:
+                events = self.epoll.poll()
+                break
+            except IOError, err:
+                if err.errno != errno.EINTR:
+                    raise
+        gone = []
+        for fd, ___ in events:
+            gone.append(self.fds.pop(fd))
+            self.epoll.unregister(fd)
+            os.close(fd)
+        return gone
+
+
+
+class PollWatch (object):
+    """Same as PidfdWatch, checking every process on an interval. For
+    kernels without pidfd_open."""
+
+    def __init__ (self, interval=10.0):
+        self.interval = interval
+        self.pids = set()
+
+
+    def __alive__ (self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, err:
+            return err.errno == errno.EPERM
+        return True
+
+
+    def add (self, pid):
+        if not self.__alive__(pid):
+            return False
+        self.pids.add(pid)
+        return True
+
+
+    def wait (self):
+        while True:
+            time.sleep(self.interval)
+            gone = [ pid  for pid in self.pids if not self.__alive__(pid) ]
+            if gone:
+                self.pids.difference_update(gone)
+                return gone
+
+
+
+def open_watch (interval):
+    """PidfdWatch, or PollWatch if the kernel can't do pidfds."""
+    try:
+        return PidfdWatch()
+    except (OSError, AttributeError), err:
+        logging.warning('no pidfd_open (%s); checking every %ss', err,
+            interval)
+        return PollWatch(interval)
+
+
+
+class Target (object):
+    """A process to wait for: a PID, or a regexp of process names."""
+
+    def __init__ (self, spec, full=False, proc='/proc'):
+        """Initializes values.
+
+        %spec: PID or regexp
+        %full: (optional) match the regexp against the whole command line
+        """
+        self.spec = spec
+        self.full = full
+        self.proc = proc
+        self.regexp = None
+        if not spec.isdigit():
+            self.regexp = re.compile(spec)
+        # Processes of the target not seen exiting yet.
+        self.pids = set()
+        self.started = time.time()
+
+
+    def __str__ (self):
+        return self.spec
+
+
+    def label (self):
+        """Spec as a metric name suffix."""
+        return re.sub('[^A-Za-z0-9]+', '_', self.spec).strip('_') or 'target'
+
+
+    def find (self):
+        """Pids of the running processes of the target. Zombies are done
+        already: their pidfds are readable right away."""
+        if self.regexp is None:
+            return set([int(self.spec)])
+
+        found = set()
+        me = os.getpid()
+        for name in os.listdir(self.proc):
+            if not name.isdigit() or int(name) == me:
+                continue
+            try:
+                if self.full:
+                    text = open('%s/%s/cmdline' % (self.proc, name)).read()
+                    text = text.rstrip('\0').replace('\0', ' ')
+                else:
+                    text = open('%s/%s/comm' % (self.proc, name)).read()
+                    text = text.rstrip('\n')
+            except IOError:
+                # Gone meanwhile.
+                continue
+            if self.regexp.search(text) and not self.zombie(name):
+                found.add(int(name))
+        return found
+
+
+    def zombie (self, pid):
+        """True if pid has exited, waiting for its parent to reap it."""
+        try:
+            stat = open('%s/%s/stat' % (self.proc, pid)).read()
+        except IOError:
+            return True
+        # comm can hold spaces and parens: the state follows the last ')'.
+        return stat.rpartition(')')[2].split()[:1] == ['Z']
+
+
+
+class Notifier (object):
+    """Tells about targets starting to be watched and finishing."""
+
+    def __init__ (self, mail=(), events_url=None, metrics=True,
+            dry_run=False):
+        """Initializes values.
+
+        %mail:       (optional) addresses to mail when a target finishes
+        %events_url: (optional) Ganglia web's 'api/events.php' URL
+        %metrics:    (optional) send 'watch_<target>' metrics: 1 while
+                     running, 0 once finished
+        """
+        self.mail = mail
+        self.events_url = events_url
+        self.metrics = metrics
+        self.dry_run = dry_run
+        self.hostname = socket.gethostname()
+
+
+    def metric (self, target, running):
+        if self.metrics:
+            gmetric_feeder.output.send([ Metric('watch_' + target.label(),
+                int(running), 'uint8', 'running') ], self.dry_run)
+
+
+    def started (self, target):
+        logging.info('%s: watching %s', target,
+            ', '.join(map(str, sorted(target.pids))) or 'nothing')
+        self.metric(target, True)
+
+
+    def finished (self, target):
+        elapsed = time.time() - target.started
+        logging.info('%s: finished after %ds watching', target, elapsed)
+        self.metric(target, False)
+
+        subject = '%s finished at %s' % (target, self.hostname)
+        for address in self.mail:
+            logging.debug('mail to %s: %s', address, subject)
+            if self.dry_run:
+                continue
+            try:
+                mailx = subprocess.Popen(['mailx', '-s', subject, address],
+                    stdin=subprocess.PIPE)
+                mailx.communicate('%s finished\n' % target)
+            except OSError, err:
+                logging.warning('mailx: %s', err)
+
+        if self.events_url:
+            query = urllib.urlencode({'action': 'add',
+                'start_time': 'now', 'summary': subject,
+                'host_regex': re.escape(self.hostname)})
+            logging.debug('event: %s?%s', self.events_url, query)
+            if self.dry_run:
+                return
+            try:
+                urllib2.urlopen('%s?%s' % (self.events_url, query),
+                    timeout=10).read()
+            except (IOError, socket.error), err:
+                logging.warning('%s: %s', self.events_url, err)
+
+
+
+def watch (targets, notifier, interval=10.0):
+    """Waits until every target is finished, telling as they do."""
+    watcher = open_watch(interval)
+    pending = []
+    for target in targets:
+        target.pids = set( pid  for pid in target.find()
+            if watcher.add(pid) )
+        notifier.started(target)
+        if target.pids:
+            pending.append(target)
+        else:
+            notifier.finished(target)
+
+    while pending:
+        gone = watcher.wait()
+        for target in pending[:]:
+            if not target.pids.intersection(gone):
+                continue
+            target.pids.difference_update(gone)
+            if not target.pids and target.regexp is not None:
+                # Matching processes started since the last look.
+                target.pids = set( pid  for pid in target.find()
+                    if watcher.add(pid) )
+            if not target.pids:
+                pending.remove(target)
+                notifier.finished(target)
+
+
+
+
+if __name__ == "__main__":
+
+    usage = """usage: %prog [options] PID|pattern..."""
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="show more information", dest="verbose")
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      help="do nothing; just show", dest="dry_run")
+    parser.add_option("-m", "--mail", action="append", default=[],
+                      help="mail this address on exits; repeatable")
+    parser.add_option("-f", "--full", action="store_true",
+                      help="match patterns against the whole command line")
+    parser.add_option("-s", "--sleep", action="store", type="float",
+                      default=10.0,
+                      help="seconds between checks, without pidfds")
+    parser.add_option("-p", "--port", action="store",
+                      help="multicast port for Ganglia")
+    parser.add_option("-H", "--host", action="store",
+                      help="multicast group or gmond host for Ganglia")
+    parser.add_option("--no-metrics", action="store_false", dest="metrics",
+                      default=True, help="don't send 'watch_*' metrics")
+    parser.add_option("-e", "--events-url", action="store",
+                      help="Ganglia web events API, as "
+                      "http://host/ganglia/api/events.php")
+
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('nothing to watch')
+
+    if opts.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    gmsaver = gmetric_feeder.gmsaver
+    if opts.port:
+        gmsaver.port = opts.port
+    if opts.host:
+        gmsaver.host = opts.host
+
+    try:
+        targets = [ Target(spec, opts.full)  for spec in args ]
+    except re.error, err:
+        parser.error('bad pattern: %s' % err)
+    watch(targets, Notifier(opts.mail, opts.events_url, opts.metrics,
+        opts.dry_run), opts.sleep)
@@ -4,14 +4,31 @@
 """
 Helps managing incremental SVN backups. Removes old backups overlapped by
 newer ones and creates a directory structure for storing the backups.
+
+Every dump under the backup root is recorded in a SQLite catalog, updated
+incrementally on every run, so cleanup and listing don't walk years of
+dated directories.
+
+--restore loads the shortest chain of dumps into a repository, streaming
+them through the decompressors straight into 'svnadmin load'.
 """
 
 import glob, os, time
+import bisect
+import errno
+import hashlib
+import itertools
+import Queue
+import sqlite3
+import subprocess
+import sys
+import threading
 from optparse import OptionParser
 import logging
 
 # Customize as needed.
 DEFAULT_DUMP_DIR = '/home/backups/svn/'
+DEFAULT_CATALOG = os.path.join(DEFAULT_DUMP_DIR, 'catalog.sqlite')
 
 
 ###### REFACTORING #######
@@ -59,8 +76,81 @@ DEFAULT_DUMP_DIR = '/home/backups/svn/'
 #############################
 
 
+def parse_dump_name (path):
+    """Splits a svn-backup-dumps generated filename, as
+    'repo.000100-000200.svndmp.gz'.
+    Returns: (repository, minor_rev, major_rev, path), revisions as ints.
+    None if path isn't named like a dump.
+    """
+    dotsplitted = os.path.basename(path).split('.')
+    try:
+        where = dotsplitted.index('svndmp') - 1
+        low, high = dotsplitted[where].split('-')
+        return ('.'.join(dotsplitted[:where]), int(low), int(high), path)
+    except ValueError:
+        return None
+
+
+
+def cover (dumps, head=None):
+    """Fewest dumps restoring revisions 0..head of one repository, one after
+    another as 'svnadmin load' needs them: every dump starting right after
+    the previous one ends. Sort and sweep: dumps are taken by minor revision,
+    so the best way of reaching a revision is known before any dump starting
+    there is looked at.
+
+    dumps: index entries (repo, minor_rev, major_rev, path).
+    head:  (optional) last revision wanted; the newest one in dumps if None.
+    Returns: (chain, gaps). chain: index entries, in load order; the last
+    one may end past head. gaps: (minor_rev, major_rev) ranges no chain of
+    dumps restores; the chain goes on after them.
+    """
+    dumps = sorted(dumps)
+    if head is None:
+        head = max([ d[2]  for d in dumps ] or [-1])
+
+    # Next revision to load -> (dumps loaded, where from, dump loaded).
+    best = {0: (0, None, None)}
+    frontier = 0
+    gaps = []
+    for dump in dumps:
+        low, high = dump[1], dump[2]
+        if low > head:
+            break
+        if low > frontier:
+            # Nothing restores frontier..low-1: go on past the gap.
+            gaps.append((frontier, low - 1))
+            best[low] = (best[frontier][0], frontier, None)
+            frontier = low
+        if low not in best:
+            # Starts halfway through some other dump.
+            continue
+        count = best[low][0] + 1
+        if high + 1 not in best or count < best[high + 1][0]:
+            best[high + 1] = (count, low, dump)
+        frontier = max(frontier, high + 1)
+
+    # Fewest dumps loading up to head; the last one may go past it.
+    ends = [ rev  for rev in best if rev > head ]
+    if ends:
+        rev = min(ends, key=lambda rev: (best[rev][0], rev))
+    else:
+        gaps.append((frontier, head))
+        rev = frontier
+
+    chain = []
+    while best[rev][1] is not None:
+        ___, rev, dump = best[rev]
+        if dump:
+            chain.append(dump)
+    chain.reverse()
+    return (chain, gaps)
+
+
+
 class SvnDmp:
-    """Represents a SVN incremental dumpfile. Can identify overlapped files.
+    """Represents a SVN incremental dumpfile. Can identify overlapped files:
+    those not needed to restore every revision.
     """
     
     def __init__(self, fnames):
@@ -75,54 +165,67 @@ class SvnDmp:
         else:
             self.fnames = fnames
             self.fnames.sort()
-        
-    
-    def __get_revisions_in_name__ (self, filename):
-        """Extracts revision numbers from a svn-backup-dumps generated filename.
-        Returs: (minor_rev, major_rev).
-        """
-        dotsplitted = filename.split('.')
-        revisions = dotsplitted[ dotsplitted.index('svndmp') - 1 ]
-        return tuple( revisions.split('-') )
 
+        # Filenames parsed once: (repo, minor_rev, major_rev, path), sorted.
+        self.dumps = [ d  for d in map(parse_dump_name, self.fnames) if d ]
+        self.dumps.sort()
+        
 
     def get_revisions (self):
         """All revision tuples (minor_rev, major_rev) for every filename in
         this object.
         """
-        return [ self.__get_revisions_in_name__(f)  for f in self.fnames ]
+        return [ ('%06d' % d[1], '%06d' % d[2])  for d in self.dumps ]
     
     
+    def coverage (self):
+        """For every repository, the fewest dumps restoring all of it (see
+        cover()). Any other dump is removable, unless it holds revisions
+        those don't.
+        Returns: (keep, gaps, removable). keep and removable: index entries.
+        gaps: (repo, minor_rev, major_rev) ranges no chain restores.
+        """
+        keep, gaps, removable = [], [], []
+        for repo, dumps in itertools.groupby(self.dumps, lambda d: d[0]):
+            dumps = list(dumps)
+            chain, repo_gaps = cover(dumps)
+            gaps += [ (repo,) + gap  for gap in repo_gaps ]
+
+            # Chain dumps never overlap: join them into runs of revisions.
+            runs = []
+            for dump in chain:
+                if runs and runs[-1][1] + 1 == dump[1]:
+                    runs[-1][1] = dump[2]
+                else:
+                    runs.append([dump[1], dump[2]])
+            starts = [ run[0]  for run in runs ]
+
+            kept = set(chain)
+            for dump in dumps:
+                if dump in kept:
+                    continue
+                where = bisect.bisect_right(starts, dump[1]) - 1
+                if where >= 0 and dump[2] <= runs[where][1]:
+                    removable.append(dump)
+                else:
+                    kept.add(dump)
+            keep += sorted(kept)
+
+        return (keep, gaps, removable)
+
+
     def get_overlapped_revisions (self):
         """Revision tuples (minor_rev, major_rev) of filenames having his
-        revisions contained in another filename.
+        revisions contained in other filenames.
         """
-        revisions = self.get_revisions()
-        minors = set( [r[0] for r in revisions] )
-    
-        result = []
-        for minor in minors:
-            majors = [int(r[1]) for r in revisions if r[0]==minor ]
-            max_majors = max(majors)
-            overlaped = [ '%06d' % maj  for maj in majors if maj != max_majors ]
-            result += [(minor, o) for o in overlaped]
-    
-        result.sort()
-        return result
-
+        return sorted(set( ('%06d' % d[1], '%06d' % d[2])
+            for d in self.coverage()[2] ))
 
     
     def get_overlapped_files (self): 
-        """Every filename having his revisions contained in another filename.
+        """Every filename having his revisions contained in other filenames.
         """
-        overlapped_files = []
-        for revs in self.get_overlapped_revisions():
-            for fname in self.fnames:
-                if '%s-%s' % revs in fname:
-                    overlapped_files.append (fname)
-                    break
-        
-        return overlapped_files
+        return [ d[3]  for d in self.coverage()[2] ]
 
 
     def __expand_fnames__ (self, fname_pattern):
@@ -171,6 +274,191 @@ def find_base_files (search_dir):
 
 
 
+class DumpCatalog:
+    """On-disk index of every dump under the backup root: repository,
+    revisions, size, mtime, checksum and the prepare_full directory it
+    belongs to. Kept up to date incrementally by update().
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dumps (
+            path TEXT PRIMARY KEY,
+            dir TEXT NOT NULL,
+            fullset TEXT NOT NULL,
+            repo TEXT NOT NULL,
+            low INTEGER NOT NULL,
+            high INTEGER NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            checksum TEXT);
+        CREATE INDEX IF NOT EXISTS dumps_repo ON dumps (repo, low, high);
+        CREATE INDEX IF NOT EXISTS dumps_dir ON dumps (dir);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            mtime REAL);
+        """
+
+    def __init__ (self, fname, root):
+        """
+        fname: SQLite database, created if needed.
+        root:  backup root, holding the prepare_full dated directories.
+        """
+        self.root = os.path.realpath(os.path.expanduser(root))
+        # Seconds a dump can still be growing after its last change.
+        self.settle = 86400
+        # Hashing every new dump takes long: runs only planning can leave
+        # it to a later update.
+        self.checksums = True
+        self.db = sqlite3.connect(fname)
+        self.db.executescript(self.SCHEMA)
+
+
+    def __inspect__ (self, path):
+        """Returns: (size, mtime, md5 hexdigest) of a file; no md5 (None)
+        unless self.checksums is set."""
+        stat = os.stat(path)
+        if not self.checksums:
+            return (stat.st_size, stat.st_mtime, None)
+        digest = hashlib.md5()
+        dump = open(path, 'rb')
+        try:
+            for block in iter(lambda: dump.read(1 << 20), ''):
+                digest.update(block)
+        finally:
+            dump.close()
+        return (stat.st_size, stat.st_mtime, digest.hexdigest())
+
+
+    def update (self):
+        """Brings the catalog in line with the backup root. Directories
+        unchanged since last time (same mtime) aren't listed again; in the
+        changed ones only new or modified files are inspected, and files
+        gone are forgotten. Writing into a file doesn't change its
+        directory's mtime, so the files in 'latest', and any modified in
+        the last settle seconds, are looked at again anyway.
+        Returns: (added, removed) dump counts.
+        """
+        added = removed = 0
+        now = time.time()
+        known_dirs = dict(self.db.execute('SELECT path, mtime FROM dirs'))
+        present = set()
+        checked = set()
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            # 'latest' is only a link to one of them.
+            if os.path.islink(path) or not os.path.isdir(path):
+                continue
+            present.add(path)
+            mtime = os.stat(path).st_mtime
+            if known_dirs.get(path) == mtime:
+                continue
+
+            known = dict( (row[0], row[1:]) for row in self.db.execute(
+                'SELECT path, size, mtime FROM dumps WHERE dir = ?', (path,)) )
+            for fname in os.listdir(path):
+                dump = parse_dump_name(fname)
+                if not dump:
+                    continue
+                fpath = os.path.join(path, fname)
+                checked.add(fpath)
+                if fpath in known:
+                    stat = os.stat(fpath)
+                    if known[fpath] == (stat.st_size, stat.st_mtime):
+                        continue
+                self.__store__(fpath, path, name, dump)
+                added += 1
+
+            gone = [ (old,)  for old in known if old not in checked ]
+            self.db.executemany('DELETE FROM dumps WHERE path = ?', gone)
+            removed += len(gone)
+            # Still being written to? Then list it again next time.
+            if now - mtime < 2:
+                mtime = None
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                (path, mtime))
+
+        for path in set(known_dirs) - present:
+            removed += self.db.execute('DELETE FROM dumps WHERE dir = ?',
+                (path,)).rowcount
+            self.db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+
+        latest = os.path.realpath(os.path.join(self.root, 'latest'))
+        growing = self.db.execute('SELECT path, dir, fullset, size, mtime '
+            'FROM dumps WHERE dir = ? OR mtime > ?',
+            (latest, now - self.settle)).fetchall()
+        for fpath, path, name, size, mtime in growing:
+            if fpath in checked:
+                continue
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                self.db.execute('DELETE FROM dumps WHERE path = ?', (fpath,))
+                removed += 1
+                continue
+            if (size, mtime) != (stat.st_size, stat.st_mtime):
+                self.__store__(fpath, path, name, parse_dump_name(fpath))
+                added += 1
+
+        if self.checksums:
+            pending = self.db.execute('SELECT path, dir, fullset FROM dumps '
+                'WHERE checksum IS NULL').fetchall()
+            for fpath, path, name in pending:
+                self.__store__(fpath, path, name, parse_dump_name(fpath))
+
+        logging.debug('catalog: %d dumps added, %d removed' % (added,
+            removed))
+        return (added, removed)
+
+
+    def __store__ (self, fpath, path, name, dump):
+        """Inspects a dump and records it."""
+        self.db.execute('INSERT OR REPLACE INTO dumps VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?)', (fpath, path, name)
+            + dump[:3] + self.__inspect__(fpath))
+
+
+    def dumps (self, repo=None, dump_dir=None):
+        """Index entries (repo, minor_rev, major_rev, path), sorted. All of
+        them, or only those of one repository and/or directory.
+        """
+        query = 'SELECT repo, low, high, path FROM dumps WHERE 1'
+        args = ()
+        if repo is not None:
+            query += ' AND repo = ?'
+            args += (repo,)
+        if dump_dir is not None:
+            query += ' AND dir = ?'
+            args += (os.path.realpath(os.path.expanduser(dump_dir)),)
+        return [ (str(r), l, h, str(p))
+            for r, l, h, p in self.db.execute(query + ' ORDER BY 1, 2, 3, 4',
+                args) ]
+
+
+    def entries (self):
+        """Every row, as (fullset, repo, minor_rev, major_rev, size,
+        checksum, path), sorted."""
+        return self.db.execute('SELECT fullset, repo, low, high, size, '
+            'checksum, path FROM dumps ORDER BY 1, 2, 3, 4').fetchall()
+
+
+    def covers (self, dump_dir):
+        """True if dump_dir is one of the directories catalogued."""
+        path = os.path.realpath(os.path.expanduser(dump_dir))
+        return os.path.dirname(path) == self.root and os.path.isdir(path)
+
+
+    def forget (self, paths):
+        """Drops removed files from the catalog."""
+        self.db.executemany('DELETE FROM dumps WHERE path = ?',
+            [ (path,)  for path in paths ])
+
+
+    def commit (self):
+        self.db.commit()
+
+
+
 ################################################################################
 
 def prepare_full (dump_root_dir):
@@ -189,20 +477,267 @@ def prepare_full (dump_root_dir):
 
 
 
-def cleanup_action (dump_dir, dry_run=False):
-    """Removes files overlapped by other files.
+def scan_dumps (dump_dir):
+    """Lists dump_dir once and splits the dumps by repository.
+    Returns: {repository: SvnDmp}.
     """
+    expanded_dir = os.path.normpath(os.path.expanduser(dump_dir))
+    by_repo = {}
+    for name in os.listdir(expanded_dir):
+        dump = parse_dump_name(name)
+        if dump:
+            by_repo.setdefault(dump[0], []).append(
+                os.path.join(expanded_dir, name))
+
+    return dict( (repo, SvnDmp(fnames))
+        for repo, fnames in by_repo.iteritems() )
 
-    base_files =  find_base_files (dump_dir)
-    overlapped = [SvnDmp(fname).get_overlapped_files()  for fname in base_files]
-    # Flat list.
-    overlapped = reduce(list.__add__, overlapped)
 
-    for fname in overlapped:
-        if dry_run:
+
+def remove_files (fnames, workers=4):
+    """Removes fnames from a bounded pool of threads: on NFS every unlink
+    is a round trip. Returns the ones that couldn't be removed.
+    """
+    pending = Queue.Queue()
+    for fname in fnames:
+        pending.put(fname)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                fname = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                os.remove(fname)
+            except OSError, err:
+                logging.error('unable to remove %s: %s' % (fname, err))
+                failed.append(fname)
+
+    threads = [ threading.Thread(target=worker)
+        for ___ in xrange(min(workers, len(fnames))) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+
+def cleanup_action (dump_dir, dry_run=False, workers=4, catalog=None):
+    """Removes files overlapped by other files, in every repository found
+    in dump_dir. Asks catalog instead of listing dump_dir, if it covers it.
+    Returns how many couldn't be removed.
+    """
+
+    if catalog is not None and catalog.covers(dump_dir):
+        by_repo = {}
+        for dump in catalog.dumps(dump_dir=dump_dir):
+            by_repo.setdefault(dump[0], []).append(dump[3])
+        repositories = dict( (repo, SvnDmp(fnames))
+            for repo, fnames in by_repo.iteritems() )
+    else:
+        repositories = scan_dumps(dump_dir)
+
+    overlapped = []
+    for repo, dumps in sorted(repositories.iteritems()):
+        keep, gaps, removable = dumps.coverage()
+        for ___, low, high in gaps:
+            logging.warning('%s: no dumps restore revisions %d-%d'
+                % (repo, low, high))
+        logging.debug('%s: %d dumps, %d kept, %d overlapped' % (repo,
+            len(dumps.dumps), len(keep), len(removable)))
+        overlapped += [ d[3]  for d in removable ]
+
+    if dry_run:
+        for fname in overlapped:
             logging.debug('remove %s' % fname)
-        else:
-            os.remove(fname)
+        return 0
+
+    failed = remove_files(overlapped, workers)
+    if catalog is not None:
+        catalog.forget(set(overlapped).difference(failed))
+    return len(failed)
+
+
+
+def list_action (catalog):
+    """Prints every dump in the catalog."""
+    for fullset, repo, low, high, size, checksum, path in catalog.entries():
+        print '%s %s %06d-%06d %12d %s %s' % (fullset, repo, low, high,
+            size, checksum or '-', path)
+
+
+
+# Decompressors by extension, writing to stdout. Plain '.svndmp' dumps
+# are loaded as they are; any other extension can't be restored.
+DECOMPRESSORS = {
+    'gz':  ['gzip', '-dc'],
+    'bz2': ['bzip2', '-dc'],
+    'xz':  ['xz', '-dc'],
+    'zip': ['unzip', '-p'],
+}
+
+
+def restore_chain (repo, rev=None, root=DEFAULT_DUMP_DIR, catalog=None):
+    """Shortest chain of dumps restoring revisions 0..rev of repo (default:
+    all of them), from every dated directory under root.
+    Returns: chain of index entries, in load order.
+    """
+    if catalog is not None:
+        dumps = catalog.dumps(repo=repo)
+    else:
+        dumps = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                repositories = scan_dumps(path)
+                if repo in repositories:
+                    dumps += repositories[repo].dumps
+
+    chain, gaps = cover(dumps, rev)
+    if gaps:
+        raise Exception, "%s: no dumps restore revisions %s." % (repo,
+            ', '.join([ '%d-%d' % gap  for gap in gaps ]))
+    if not chain:
+        raise Exception, "%s: no dumps found." % repo
+    for dump in chain:
+        extension = dump[3].rsplit('.', 1)[-1]
+        if extension != 'svndmp' and extension not in DECOMPRESSORS:
+            raise Exception, "%s: don't know how to decompress it." % dump[3]
+    return chain
+
+
+
+def decompress_into (chain, chunks, stop, blocksize=1 << 20):
+    """Puts the dumps in chain, decompressed, into the chunks queue as
+    (dump number, data) tuples; then None. Decompressors run ahead of the
+    load as far as the queue lets them. Errors are put as exceptions.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    try:
+        for number, dump in enumerate(chain):
+            path = dump[3]
+            extension = path.rsplit('.', 1)[-1]
+            if extension in DECOMPRESSORS:
+                proc = subprocess.Popen(DECOMPRESSORS[extension] + [path],
+                    stdout=subprocess.PIPE)
+                source = proc.stdout
+            else:
+                proc = None
+                source = open(path, 'rb')
+            try:
+                for block in iter(lambda: source.read(blocksize), ''):
+                    if not put((number, block)):
+                        return
+            finally:
+                source.close()
+                if proc is not None:
+                    if stop.is_set() and proc.poll() is None:
+                        proc.kill()
+                    if proc.wait():
+                        raise Exception, "%s: %s exited with %d." % (path,
+                            DECOMPRESSORS[extension][0], proc.returncode)
+        put(None)
+    except Exception, err:
+        put(err)
+
+
+
+def restore_action (repo_path, rev=None, dry_run=False,
+        root=DEFAULT_DUMP_DIR, catalog=None, prefetch=64):
+    """Loads the shortest chain of dumps up to rev into the repository at
+    repo_path (created if missing), named as its basename. Dumps are
+    decompressed in a parallel stage and streamed into one 'svnadmin load':
+    no temporary files. An existing repository must be empty: the chain
+    starts at revision 0.
+    """
+    repo = os.path.basename(os.path.normpath(repo_path))
+    chain = restore_chain(repo, rev, root, catalog)
+    total = sum([ os.path.getsize(dump[3])  for dump in chain ])
+    for dump in chain:
+        logging.info('%s: %06d-%06d from %s' % (repo, dump[1], dump[2],
+            dump[3]))
+
+    command = ['svnadmin', 'load', '--quiet']
+    if rev is not None and chain[-1][2] > rev:
+        command += ['--revision', '0:%d' % rev]
+    command.append(repo_path)
+    if os.path.exists(repo_path):
+        youngest = subprocess.check_output(['svnadmin', 'youngest', repo_path])
+        if youngest.strip() != '0':
+            raise Exception, "%s is at revision %s, not empty." % (repo_path,
+                youngest.strip())
+    if dry_run:
+        logging.debug(' '.join(command))
+        return
+
+    if not os.path.exists(repo_path):
+        subprocess.check_call(['svnadmin', 'create', repo_path])
+    load = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    # prefetch MB decompressed ahead of the load, at most.
+    chunks = Queue.Queue(prefetch)
+    stop = threading.Event()
+    reader = threading.Thread(target=decompress_into,
+        args=(chain, chunks, stop))
+    reader.daemon = True
+    reader.start()
+
+    start = last = time.time()
+    loaded = 0
+    complete = False
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                complete = True
+                break
+            if isinstance(item, Exception):
+                raise item
+            number, block = item
+            try:
+                load.stdin.write(block)
+            except IOError, err:
+                # svnadmin is gone; its exit status tells why.
+                if err.errno != errno.EPIPE:
+                    raise
+                break
+            loaded += len(block)
+            now = time.time()
+            if now - last >= 10:
+                logging.info('%s: dump %d of %d, %.1f MB loaded, %.1f MB/s'
+                    % (repo, number + 1, len(chain), loaded / 1e6,
+                    loaded / 1e6 / (now - start)))
+                last = now
+    finally:
+        stop.set()
+        if not complete:
+            # Closing stdin would have svnadmin commit what it got so far.
+            load.kill()
+        try:
+            load.stdin.close()
+        except IOError:
+            # svnadmin is gone; its exit status tells why.
+            pass
+        reader.join()
+        load.wait()
+
+    if load.returncode or not complete:
+        raise Exception, "svnadmin load exited with %d." % load.returncode
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('%s: %d dumps, %.1f MB (%.1f MB on disk) in %ds, %.1f MB/s'
+        % (repo, len(chain), loaded / 1e6, total / 1e6, elapsed,
+        loaded / 1e6 / elapsed))
 
 
 
@@ -219,6 +754,21 @@ def main():
         help=u'creates a directory structure for doing a full dump' )
     parser.add_option("-n", "--dry-run", action="store_true",
                       help="do nothing; just show", dest="dry_run")
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      default=4, help="files removed at once on cleanup")
+    parser.add_option("-l", "--list", action="store_true", dest="list",
+                      default=False, help="lists every dump in the catalog")
+    parser.add_option("--catalog", action="store", dest="catalog",
+                      default=DEFAULT_CATALOG,
+                      help="dump catalog [default: %default]")
+    parser.add_option("--no-catalog", action="store_const", const=None,
+                      dest="catalog", help="list directories every time")
+    parser.add_option("--restore", action="store", dest="restore",
+                      metavar="REPO",
+                      help="loads the dumps of basename(REPO) into REPO, "
+                      "created if missing; an existing REPO must be empty")
+    parser.add_option("--rev", action="store", type="int", dest="rev",
+                      help="restores up to this revision [default: all]")
     (options, args) = parser.parse_args()
 
     # Set debug level.
@@ -226,12 +776,53 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
-    
+
+    # Only listing, cleanup and restore look at the catalog.
+    catalog = None
+    if options.catalog and os.path.isdir(DEFAULT_DUMP_DIR) and (options.list
+            or options.cleanup or options.restore):
+        try:
+            catalog = DumpCatalog(options.catalog, DEFAULT_DUMP_DIR)
+            catalog.checksums = not (options.dry_run or options.restore)
+            catalog.update()
+        except (sqlite3.Error, IOError, OSError), err:
+            logging.warning('%s: %s; going without catalog' % (
+                options.catalog, err))
+            catalog = None
+    if options.list and catalog is None:
+        parser.error('no catalog to list')
+
+    if options.list:
+        list_action (catalog)
+
     if options.cleanup:
         if len(args) < 1:
-            cleanup_action (os.path.join(DEFAULT_DUMP_DIR, 'latest'))
+            dump_dir = os.path.join(DEFAULT_DUMP_DIR, 'latest')
         else:
-            cleanup_action (args[0], dry_run=options.dry_run)
+            dump_dir = args[0]
+        failed = cleanup_action (dump_dir, dry_run=options.dry_run,
+            workers=options.workers, catalog=catalog)
+    else:
+        failed = 0
+
+    # A dry run doesn't even touch the catalog.
+    if catalog is not None and not options.dry_run:
+        try:
+            catalog.commit()
+        except sqlite3.Error, err:
+            logging.warning('%s: %s; catalog not updated' % (
+                options.catalog, err))
+    if failed:
+        sys.exit(1)
+
+    if options.restore:
+        try:
+            restore_action (options.restore, options.rev,
+                dry_run=options.dry_run, root=DEFAULT_DUMP_DIR,
+                catalog=catalog)
+        except Exception, err:
+            logging.error(err)
+            sys.exit(1)
 
     if options.prepare_full:
         prepare_full (DEFAULT_DUMP_DIR)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# svn_backup_bench.py
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for svn_backup.py over synthetic dump filenames. Needs no
+real dumps: names are made up the way svn-backup-dumps writes them, and
+dump directories are filled with empty files.
+
+Every result is milliseconds per operation, lower is better. Results can be
+saved as a baseline and later runs compared against it:
+
+    svn_backup_bench.py --save baseline.json
+    svn_backup_bench.py --baseline baseline.json
+
+Exits with status 1 if something got slower than the baseline allows.
+"""
+
+
+import logging
+import os
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import svn_backup
+from bench_util import add_baseline_options, per_round, report
+
+
+def fake_dump_names(count, repos=1, rerun=4, weekly=7):
+    """count dump filenames over repos repositories, shuffled. Every minor
+    revision is dumped up to rerun times, each reaching further, like
+    nightly incrementals run again before the next one starts. Every weekly
+    nights there is also a dump covering the whole week."""
+    names = []
+    per_repo = count // repos
+    for repo in xrange(repos):
+        low = week = 0
+        nights = 0
+        while len(names) < per_repo * (repo + 1):
+            high = low
+            for ___ in xrange(random.randint(1, rerun)):
+                high += random.randint(1, 50)
+                names.append('/backups/svn/latest/repo%d.%06d-%06d.svndmp.gz'
+                    % (repo, low, high))
+            low = high + 1
+            nights += 1
+            if nights % weekly == 0:
+                names.append('/backups/svn/latest/repo%d.%06d-%06d.svndmp.gz'
+                    % (repo, week, high))
+                week = low
+    random.shuffle(names)
+    return names[:count]
+
+
+
+def bench_overlap(dumps, rounds):
+    """Indexing dump names and finding the overlapped ones."""
+    names = fake_dump_names(dumps)
+    return [
+        ('parse_%d_names' % dumps, per_round(
+            lambda: map(svn_backup.parse_dump_name, names), rounds)),
+        ('index_%d_dumps' % dumps, per_round(
+            lambda: svn_backup.SvnDmp(names[:]), rounds)),
+        ('overlapped_%d_dumps' % dumps, per_round(
+            lambda: svn_backup.SvnDmp(names[:]).get_overlapped_files(),
+            rounds)),
+    ]
+
+
+
+def bench_cleanup(tmpdir, files, rounds):
+    """Listing a dump directory with several repositories and finding
+    what to remove, without removing it."""
+    for name in fake_dump_names(files, repos=10):
+        open(os.path.join(tmpdir, os.path.basename(name)), 'w').close()
+    return [
+        ('scan_%d_files' % files, per_round(
+            lambda: svn_backup.scan_dumps(tmpdir), rounds)),
+        ('cleanup_dry_run_%d_files' % files, per_round(
+            lambda: svn_backup.cleanup_action(tmpdir, dry_run=True),
+            rounds)),
+    ]
+
+
+
+if __name__ == "__main__":
+
+    usage = """usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-d", "--dumps", action="store", type="int",
+                      default=100000, help="synthetic dump filenames")
+    parser.add_option("-f", "--files", action="store", type="int",
+                      default=10000, help="dump files on the fake dump dir")
+    parser.add_option("-r", "--rounds", action="store", type="int",
+                      default=5, help="rounds for every benchmark")
+    add_baseline_options(parser)
+    opts, ___ = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # Same names on every run.
+    random.seed(0)
+    tmpdir = tempfile.mkdtemp(prefix='svn_backup_bench.')
+    try:
+        results = bench_overlap(opts.dumps, opts.rounds)
+        results += bench_cleanup(tmpdir, opts.files, opts.rounds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report(results, opts)